@@ -38,8 +38,10 @@ from pkg_resources import resource_filename
 from pkg_resources import iter_entry_points
 
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
 from pyramid.exceptions import ConfigurationError
 from pyramid.i18n import get_locale_name
+from pyramid.settings import asbool
 
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.httpexceptions import HTTPForbidden, HTTPBadRequest
@@ -50,9 +52,19 @@ from eduid_userdb.actions import ActionDB
 from eduid_userdb.userdb import UserDB
 from eduid_am.celery import celery
 from eduid_common.config.parsers import IniConfigParser
+from eduid_actions.action_abc import PrefetchPool
 from eduid_actions.i18n import locale_negotiator
+from eduid_actions.i18n import install_inline_translations
 from eduid_actions.context import RootFactory
-from eduid_actions.session import SessionFactory
+from eduid_actions.session import SessionFactory, CookieSessionFactory
+from eduid_actions.sentinel import make_redis_pool
+from eduid_actions.errors import ErrorPages
+from eduid_actions.logs import set_sample_rates
+from eduid_actions.pending import PendingActionsIndex
+from eduid_actions.purge import PurgeJob
+from eduid_actions.stats import QueueStats
+from eduid_actions.user import get_current_user, invalidate_current_user
+from eduid_actions.user import UserCache, invalidate_on_update_attributes
 
 
 log = logging.getLogger('eduid_actions')
@@ -63,16 +75,27 @@ class PluginsRegistry(dict):
     def __init__(self, name, settings):
         for entry_point in iter_entry_points(name):
             if entry_point.name in self:
-                log.warn("Duplicate entry point: %s" % entry_point.name)
+                log.warn("Duplicate entry point: %s", entry_point.name)
             else:
-                log.debug("Registering entry point: %s" % entry_point.name)
+                log.debug("Registering entry point: %s", entry_point.name)
                 self[entry_point.name] = entry_point.load()
+                _check_single_request_steps(entry_point.name,
+                                            self[entry_point.name])
                 package_name = 'eduid_action.' + entry_point.name
                 locale_path = resource_filename(package_name, 'locale')
                 self[entry_point.name].init_languages(settings, locale_path,
                                                       entry_point.name)
 
 
+def _check_single_request_steps(name, plugin):
+    if getattr(plugin, 'single_request_steps', False) and \
+            getattr(plugin, 'get_action_body_for_all_steps', None) is None:
+        log.error("Plugin %s sets single_request_steps without implementing "
+                  "get_action_body_for_all_steps, its steps will be "
+                  "presented one at a time", name)
+        plugin.single_request_steps = False
+
+
 def jinja2_settings(settings):
     settings.setdefault('jinja2.i18n.domain', 'eduid-actions')
     settings.setdefault('jinja2.newstyle', True)
@@ -107,6 +130,18 @@ def includeme(config):
     config.set_request_property(lambda x: x.registry.settings['amdb'],
                                 'amdb', reify=True)
 
+    user_cache_size = int(settings.get('user_cache.size', 0))
+    if user_cache_size > 0:
+        user_cache = UserCache(amdb, user_cache_size,
+                               int(settings.get('user_cache.ttl', 30)))
+        invalidate_on_update_attributes(user_cache)
+        config.registry.settings['user_cache'] = user_cache
+
+    # The user in the session, loaded at most once per request
+    config.add_request_method(get_current_user, 'current_user', reify=True)
+    config.add_request_method(invalidate_current_user,
+                              'invalidate_current_user')
+
     # configure Celery broker
     broker_url = cp.read_setting_from_env(settings, 'broker_url', 'amqp://')
     celery_conf = {
@@ -119,40 +154,89 @@ def includeme(config):
     settings['celery'] = celery
     settings['broker_url'] = broker_url
 
+    # Load shedding on the entry point
+    config.include('eduid_actions.ratelimit')
+
+    # Sampling profiler
+    config.include('eduid_actions.profiling')
+
+    # Memory diagnostics
+    config.include('eduid_actions.memory')
+
+    # Compression of the rendered pages
+    config.include('eduid_actions.compression')
+
+    # Audit log of the lifecycle of the actions
+    config.include('eduid_actions.audit')
+
+    # Suppression of duplicated form submissions
+    config.include('eduid_actions.submits')
+
+    # Static error pages, served from memory
+    settings['error_pages'] = ErrorPages(settings)
+
     # Favicon
     config.add_route('favicon', '/favicon.ico')
     # Errors
     config.add_route('error404', '/error404/')
     config.add_view(context=HTTPNotFound,
-                    view='eduid_actions.views.not_found_view',
-                    renderer='error404.jinja2')
+                    view='eduid_actions.views.not_found_view')
     config.add_route('forbidden403', '/error403/')
     config.add_view(context=HTTPForbidden,
-                    view='eduid_actions.views.forbidden_view',
-                    renderer='error403.jinja2')
+                    view='eduid_actions.views.forbidden_view')
     config.add_route('badrequest400', '/error400/')
     config.add_view(context=HTTPBadRequest,
                     view='eduid_actions.views.bad_request_view',
                     renderer='error400.jinja2')
     config.add_route('notallowed405', '/error405/')
     config.add_view(context=HTTPMethodNotAllowed,
-                    view='eduid_actions.views.method_not_allowed_view',
-                    renderer='error405.jinja2')
+                    view='eduid_actions.views.method_not_allowed_view')
     config.add_route('error500', '/error500/')
     config.add_view(context=HTTPInternalServerError,
-                    view='eduid_actions.views.exception_view',
-                    renderer='error500.jinja2')
+                    view='eduid_actions.views.exception_view')
     config.add_view(context=Exception,
-                    view='eduid_actions.views.exception_view',
-                    renderer='error500.jinja2')
+                    view='eduid_actions.views.exception_view')
 
     config.add_route('actions', '/')
     config.add_route('perform-action', '/perform-action')
 
+    # Internal endpoints
+    config.add_route('pending-actions', '/internal/pending-actions')
+    config.add_route('bulk-enqueue', '/internal/bulk-enqueue')
+    config.add_route('queue-stats', '/internal/stats')
+    config.add_route('memory-stats', '/internal/memory')
+    settings['queue_stats'] = QueueStats(
+        actions_db, cache_ttl=int(settings.get('stats.cache_ttl', 60)))
+    if asbool(settings.get('pending_actions_index.enabled', False)):
+        settings['pending_actions_index'] = PendingActionsIndex(
+            actions_db,
+            poll_interval=float(settings.get(
+                'pending_actions_index.poll_interval', 1)),
+            max_lag=float(settings.get(
+                'pending_actions_index.max_lag', 5)),
+            full_reload=float(settings.get(
+                'pending_actions_index.full_reload', 300)))
+
+    # Thread pool for the loaders prefetched by the plugins
+    settings['prefetch_executor'] = PrefetchPool(
+        max_workers=int(settings.get('prefetch.max_workers', 8)),
+        max_pending=int(settings.get('prefetch.max_pending', 32)))
+    settings['prefetch_timeout'] = float(settings.get('prefetch.timeout', 10))
+
     # Plugin registry
     settings['action_plugins'] = PluginsRegistry('eduid_actions.action',
                                                  settings)
 
+    # Periodic purge of stale actions, started in each worker
+    purge_interval = int(settings.get('purge.interval', 0))
+    if purge_interval > 0:
+        purge_job = PurgeJob(
+            actions_db, purge_interval,
+            session_max_age=int(settings.get('purge.session_max_age', 86400)),
+            batch_size=int(settings.get('purge.batch_size', 500)),
+            pause=float(settings.get('purge.pause', 0.1)))
+        config.add_subscriber(purge_job.ensure_started, NewRequest)
+
 
 def main(global_config, **settings):
     """ This function returns a WSGI application.
@@ -177,6 +261,11 @@ def main(global_config, **settings):
                                                             'lang_cookie_name',
                                                             'lang')
 
+    settings['internal_api_secret'] = cp.read_setting_from_env(
+        settings, 'internal_api_secret', None)
+
+    set_sample_rates(settings)
+
     for item in (
         'mongo_uri',
         'site.name',
@@ -209,10 +298,6 @@ def main(global_config, **settings):
 
     jinja2_settings(settings)
 
-    config = Configurator(settings=settings,
-                          root_factory=RootFactory,
-                          locale_negotiator=locale_negotiator)
-
     settings['REDIS_HOST'] = cp.read_setting_from_env(settings, 'redis_host',
                                                       'redis.docker')
 
@@ -227,8 +312,23 @@ def main(global_config, **settings):
         default=[])
     settings['REDIS_SENTINEL_SERVICE_NAME'] = cp.read_setting_from_env(settings, 'redis_sentinel_service_name',
                                                                        'redis-cluster')
+    if settings['REDIS_SENTINEL_HOSTS']:
+        # Cached master discovery, shared by all the redis clients
+        settings['redis_pool'] = make_redis_pool(settings)
 
-    session_factory = SessionFactory(settings)
+    config = Configurator(settings=settings,
+                          root_factory=RootFactory,
+                          locale_negotiator=locale_negotiator)
+
+    session_backend = cp.read_setting_from_env(settings, 'session.backend',
+                                               'redis')
+    if session_backend == 'redis':
+        session_factory = SessionFactory(settings)
+    elif session_backend == 'cookie':
+        session_factory = CookieSessionFactory(settings)
+    else:
+        raise ConfigurationError(
+            'Unknown session.backend {0}'.format(session_backend))
     config.set_session_factory(session_factory)
 
     config.set_request_property(get_locale_name, 'locale', reify=True)
@@ -251,4 +351,9 @@ def main(global_config, **settings):
 
     config.scan(ignore=[re.compile('.*tests.*').search, '.testing'])
 
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+
+    if asbool(settings.get('jinja2.inline_translations', False)):
+        install_inline_translations(config)
+
+    return app
@@ -31,6 +31,12 @@
 #
 from abc import ABCMeta, abstractmethod
 import gettext
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import logging
+logger = logging.getLogger('eduid_actions')
 
 
 class ActionError(Exception):
@@ -79,6 +85,85 @@ class ActionError(Exception):
         self.remove_action = rm
 
 
+class PrefetchPool(object):
+    '''
+    Thread pool for the loaders returned by ``ActionPlugin.prefetch``,
+    with at most `max_pending` loaders waiting for one of its
+    `max_workers` threads. When it is full, `submit` returns None, and
+    the loader is run inline once its result is needed.
+
+    :param max_workers: the number of threads
+    :param max_pending: the number of loaders that may wait for a thread
+    :type max_workers: int
+    :type max_pending: int
+    '''
+
+    def __init__(self, max_workers=8, max_pending=32):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def submit(self, loader):
+        '''
+        Run the loader on the pool, if there is room for it.
+
+        :param loader: callable without arguments
+        :type loader: callable
+        :return: the future of the loader, or None if the pool is full
+        :rtype: concurrent.futures.Future or None
+        '''
+        if not self._slots.acquire(False):
+            return None
+        try:
+            future = self._executor.submit(loader)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+
+class Prefetched(dict):
+    '''
+    The results of the loaders returned by ``ActionPlugin.prefetch``,
+    keyed by loader name. Values are futures running on a thread pool,
+    and getting an item waits for its loader to finish, returning its
+    result or raising its exception. A loader that found the pool full,
+    or that does not finish within `timeout` seconds, is run inline.
+
+    :param loaders: the loaders, keyed by name
+    :param futures: their futures, keyed by name, None for the loaders
+                    that could not be queued
+    :param timeout: the seconds to wait for each loader
+    :type loaders: dict
+    :type futures: dict
+    :type timeout: float
+    '''
+
+    def __init__(self, loaders=None, futures=None, timeout=None):
+        super(Prefetched, self).__init__(futures or {})
+        self.loaders = loaders or {}
+        self.timeout = timeout
+        self._inline = {}
+
+    def __getitem__(self, name):
+        future = super(Prefetched, self).__getitem__(name)
+        if future is not None:
+            try:
+                return future.result(self.timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                logger.warning('Prefetching %s timed out, loading it '
+                               'inline', name)
+        if name not in self._inline:
+            self._inline[name] = self.loaders[name]()
+        return self._inline[name]
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return self[name]
+
+
 class ActionPlugin:
     '''
     Abstract class to be extended by the different plugins for the
@@ -138,10 +223,14 @@ class ActionPlugin:
         translations = cls.get_translations()
         available_languages = settings['available_languages'].keys()
         domain = 'eduid_action.' + plugin_name
+        # Build all the translations before adding them, so that
+        # requests in other threads never see a half filled dict.
+        loaded = {}
         for lang in available_languages:
-            translations[lang] = gettext.translation(domain,
-                                                     locale_path,
-                                                     languages=[lang])
+            loaded[lang] = gettext.translation(domain,
+                                               locale_path,
+                                               languages=[lang])
+        translations.update(loaded)
 
     def get_language(self, request):
         '''
@@ -167,6 +256,35 @@ class ActionPlugin:
             locale_name = settings.get('default_locale_name', 'sv')
         return locale_name
 
+    prefetched = Prefetched()
+    '''
+    The results of the loaders returned by ``prefetch``, set by the
+    actions app on each plugin object before calling its other methods.
+    '''
+
+    def prefetch(self, action, request):
+        '''
+        Return the independent pieces of I/O needed by the next call to
+        ``get_action_body_for_step``, as a dict of names to callables
+        without arguments. The actions app runs them concurrently on a
+        bounded thread pool, and their results are available as
+        ``self.prefetched[name]``. Nothing is prefetched before calling
+        ``perform_action`` on the last step, since that usually ends
+        in a redirect rather than in a rendered step.
+
+        The loaders run in other threads, so they must not rely on the
+        thread local request or registry of pyramid.
+
+        :param action: the action as retrieved from the eduid_actions db
+        :param request: the request
+        :returns: the loaders
+
+        :type action: dict
+        :type request: pyramid.request.Request
+        :rtype: dict
+        '''
+        return {}
+
     def get_ugettext(self, request):
         '''
         get the ugettext method that corresponds to the given request.
@@ -186,10 +304,40 @@ class ActionPlugin:
         either in `get_action_body_for_step`, or in `perform_action`.
         Instantiated with a dict of field names to error messages.
 
+        Plugins with ``single_request_steps`` may also give the step
+        with the failing fields, to be shown first when the steps
+        are presented again.
+
         :param arg: error messages for each field
+        :param step: the step with the failing fields
         :type arg: dict
+        :type step: int
         '''
 
+        def __init__(self, errors, step=None):
+            super(ActionPlugin.ValidationError, self).__init__(errors)
+            self.step = step
+
+    single_request_steps = False
+    '''
+    Plugins with more than one step can set this to True to present
+    all the steps in a single response, with navigation between them
+    done on the client side, and a single POST to perform the action.
+
+    They must then implement::
+
+        get_action_body_for_all_steps(self, action, request, errors=None,
+                                      step=1)
+
+    returning, as ``get_action_body_for_step``, the template and data, or
+    None and the html, with the forms for all the steps as a single form
+    to be submitted once. The submitted data is handed to
+    ``perform_action``, that may raise ValidationError giving the failing
+    step, which is then passed as `step` to be shown first. Plugins that
+    set this without implementing the method are registered with
+    ``single_request_steps`` unset.
+    '''
+
     @classmethod
     @abstractmethod
     def includeme(self, config):
@@ -0,0 +1,272 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+import atexit
+import threading
+from collections import deque
+from datetime import datetime
+
+from bson import ObjectId
+from pyramid.exceptions import ConfigurationError
+
+from eduid_actions.threads import ForkSafeThread
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+STARTED = 'started'
+FINISHED = 'finished'
+ABORTED = 'aborted'
+REMOVED = 'removed'
+
+EVENT_TYPES = (STARTED, FINISHED, ABORTED, REMOVED)
+
+
+class AuditEvent(object):
+    '''
+    An event in the lifecycle of an action.
+
+    :param event_type: one of `STARTED`, `FINISHED`, `ABORTED`, `REMOVED`
+    :param action: the action
+    :param step: the step of the action the event happened at
+    :param reason: why the action was aborted or removed
+
+    :type event_type: str
+    :type action: eduid_userdb.actions.Action
+    :type step: int
+    :type reason: unicode
+    '''
+    __slots__ = ('event_type', 'action_type', 'action_id', 'user_oid',
+                 'idp_session', 'step', 'reason', 'ts')
+
+    def __init__(self, event_type, action, step=None, reason=None):
+        if event_type not in EVENT_TYPES:
+            raise ValueError('Unknown audit event: {0}'.format(event_type))
+        self.event_type = event_type
+        self.action_type = action.action_type
+        # The actions kept in the session have their ids as strings
+        self.action_id = ObjectId(str(action.action_id))
+        self.user_oid = ObjectId(str(action.user_id))
+        self.idp_session = action.session
+        self.step = step
+        self.reason = reason
+        self.ts = datetime.utcnow()
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+class MongoAuditSink(object):
+    '''
+    Write the audit events to a mongo collection.
+    '''
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def write(self, events):
+        self.collection.insert_many([event.to_dict() for event in events],
+                                    ordered=False)
+
+
+class JSONLinesAuditSink(object):
+    '''
+    Append the audit events to a file, one JSON object per line.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events):
+        lines = [json.dumps(event.to_dict(), default=str, sort_keys=True)
+                 for event in events]
+        with open(self.path, 'a') as fd:
+            fd.write('\n'.join(lines) + '\n')
+
+
+class AuditLog(object):
+    '''
+    Buffer of audit events, written to `sink` in batches of up to
+    `batch_size` events from a background thread, every `flush_interval`
+    seconds or as soon as a batch is full. Recording an event never
+    touches the sink.
+
+    The thread is started by the first event recorded in each process,
+    so that it runs in the forked workers rather than in the parent.
+
+    At most `max_events` events are buffered; events recorded while the
+    buffer is full are dropped, and events in batches the sink failed to
+    write are lost. Both are counted, in `dropped` and `failed`.
+    '''
+
+    def __init__(self, sink, batch_size=100, flush_interval=5,
+                 max_events=10000):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer = ForkSafeThread(self._run, 'audit-log',
+                                      on_fork=self._forked)
+
+    def record(self, event):
+        '''
+        Add an event to the buffer.
+
+        :param event: the event
+        :type event: AuditEvent
+        '''
+        if self._writer.ensure_started():
+            atexit.register(self.flush)
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                self.dropped += 1
+                return
+            self._events.append(event)
+            full = len(self._events) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        '''
+        Write all the buffered events to the sink.
+        '''
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    count = min(len(self._events), self.batch_size)
+                    batch = [self._events.popleft() for i in range(count)]
+                if not batch:
+                    return
+                try:
+                    self.sink.write(batch)
+                    self.written += len(batch)
+                except Exception as exc:
+                    self.failed += len(batch)
+                    logger.warning('Could not write %d audit events: %r',
+                                   len(batch), exc)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._events)
+        return {
+            'pending': pending,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _forked(self):
+        # The events buffered by the parent are the parent's to write.
+        with self._lock:
+            self._events.clear()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+def audit(request, event_type, action, step=None, reason=None):
+    '''
+    Record an audit event for `action`, if the audit log is enabled.
+
+    :param request: the request
+    :param event_type: one of `STARTED`, `FINISHED`, `ABORTED`, `REMOVED`
+    :param action: the action
+    :param step: the step of the action the event happened at
+    :param reason: why the action was aborted or removed
+
+    :type request: pyramid.request.Request
+    :type event_type: str
+    :type action: eduid_userdb.actions.Action
+    :type step: int
+    :type reason: unicode
+    '''
+    audit_log = request.registry.settings.get('audit_log')
+    if audit_log is not None:
+        audit_log.record(AuditEvent(event_type, action, step, reason))
+
+
+def audit_started(request, action):
+    '''
+    Record the `STARTED` event for `action`, unless it has already been
+    recorded for it in this session, as when the page is reloaded.
+
+    :param request: the request
+    :param action: the action
+    :type request: pyramid.request.Request
+    :type action: eduid_userdb.actions.Action
+    '''
+    if request.registry.settings.get('audit_log') is None:
+        return
+    action_id = str(action.action_id)
+    if request.session.get('audit_started') == action_id:
+        return
+    request.session['audit_started'] = action_id
+    audit(request, STARTED, action, step=1)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    sink_name = settings.get('audit.sink')
+    if not sink_name:
+        settings['audit_log'] = None
+        return
+    if sink_name == 'mongo':
+        coll = settings['actions_db']._coll
+        sink = MongoAuditSink(
+            coll.database[settings.get('audit.collection', 'actions_audit')])
+    elif sink_name == 'file':
+        if not settings.get('audit.path'):
+            raise ConfigurationError(
+                'The audit.path configuration option is required '
+                'for the file audit sink')
+        sink = JSONLinesAuditSink(settings['audit.path'])
+    else:
+        raise ConfigurationError(
+            'Unknown audit.sink: {0}'.format(sink_name))
+    audit_log = AuditLog(
+        sink,
+        batch_size=int(settings.get('audit.batch_size', 100)),
+        flush_interval=float(settings.get('audit.flush_interval', 5)),
+        max_events=int(settings.get('audit.max_events', 10000)))
+    settings['audit_log'] = audit_log
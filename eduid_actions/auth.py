@@ -31,6 +31,7 @@
 #
 
 from hashlib import sha256
+import hmac
 import time
 
 from pyramid.i18n import TranslationString as _
@@ -57,17 +58,17 @@ def verify_auth_token(shared_key, userid, token, nonce, timestamp, generator=sha
     :param generator: hash function to use (default: SHA-256)
     :return: bool, True on valid authentication
     """
-    logger.debug("Trying to authenticate user {!r} with auth token {!r}".format(userid, token))
+    logger.debug("Trying to authenticate user %r", userid)
     # check timestamp to make sure it is within -300..900 seconds from now
     now = int(time.time())
     ts = int(timestamp, 16)
     if (ts < now - 300) or (ts > now + 900):
-        logger.debug("Auth token timestamp {!r} out of bounds ({!s} seconds from {!s})".format(
-            timestamp, ts - now, now))
+        logger.debug("Auth token timestamp %r out of bounds (%s seconds from %s)",
+                     timestamp, ts - now, now)
         raise HTTPForbidden(_('Login token expired, please try to log in again.'))
     # verify there is a long enough nonce
     if len(nonce) < 16:
-        logger.debug("Auth token nonce {!r} too short".format(nonce))
+        logger.debug("Auth token nonce %r too short", nonce)
         raise HTTPForbidden(_('Login token invalid'))
 
     expected = generator("{0}|{1}|{2}|{3}".format(
@@ -80,5 +81,25 @@ def verify_auth_token(shared_key, userid, token, nonce, timestamp, generator=sha
     result = 0
     for x, y in zip(expected, token):
         result |= ord(x) ^ ord(y)
-    logger.debug("Auth token match result: {!r}".format(result == 0))
+    logger.debug("Auth token match result: %r", result == 0)
     return result == 0
+
+
+def verify_internal_request(request):
+    """
+    Authenticate a request to one of the internal endpoints,
+    that must carry the configured ``internal_api_secret`` in the
+    X-Internal-Secret header.
+
+    :param request: the request
+    :raise: HTTPForbidden if the secret is not configured or does not match
+    """
+    expected = request.registry.settings.get('internal_api_secret')
+    provided = request.headers.get('X-Internal-Secret', '')
+    if not expected:
+        logger.debug("No internal_api_secret configured")
+        raise HTTPForbidden()
+    if not hmac.compare_digest(expected.encode('utf-8'),
+                               provided.encode('utf-8')):
+        logger.info("Bad secret in request to internal endpoint")
+        raise HTTPForbidden()
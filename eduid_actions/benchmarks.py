@@ -0,0 +1,375 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys
+import json
+import time
+import platform
+import argparse
+from hashlib import sha256
+from collections import OrderedDict
+from timeit import default_timer
+
+from bson import ObjectId
+
+from eduid_userdb.actions import Action
+from eduid_actions.action_abc import ActionPlugin
+
+
+BENCHMARKS = OrderedDict()
+
+USERID = '123467890123456789014567'
+
+ACTION = {
+    '_id': ObjectId('234567890123456789012301'),
+    'user_oid': ObjectId(USERID),
+    'action': 'bench',
+    'preference': 100,
+    'params': {},
+}
+
+SETTINGS = {
+    'site.name': 'Benchmarks',
+    'auth_shared_secret': 'bench-secret',
+    'pyramid.includes': 'pyramid_jinja2',
+    'jinja2.directories': 'eduid_actions:templates',
+    'jinja2.undefined': 'strict',
+    'jinja2.i18n.domain': 'eduid-actions',
+    'jinja2.filters': """
+                route_url = pyramid_jinja2.filters:route_url_filter
+                static_url = pyramid_jinja2.filters:static_url_filter
+                """,
+    'session.backend': 'cookie',
+    'session.key': 'session',
+    'session.secret': 'bench-session-secret',
+    'idp_url': 'http://example.com/idp',
+}
+
+
+def benchmark(name):
+    '''
+    Register a benchmark. The decorated function is called once with
+    the shared `BenchContext`, and returns the callable to be timed.
+    '''
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+class _MemoryActionDB(object):
+    '''
+    Stand-in for the ActionDB, keeping the actions in a list.
+    '''
+
+    def __init__(self):
+        self.actions = []
+
+    def add_action(self, data):
+        self.actions.append(Action(data=dict(data)))
+
+    def get_next_action(self, userid, session=None):
+        pending = [a for a in self.actions if str(a.user_id) == str(userid)
+                   and a.session in (None, session)]
+        if not pending:
+            return None
+        return min(pending, key=lambda a: a.preference)
+
+    def update_action(self, action):
+        self.remove_action_by_id(action.action_id)
+        self.actions.append(action)
+
+    def remove_action_by_id(self, action_id):
+        self.actions = [a for a in self.actions
+                        if str(a.action_id) != str(action_id)]
+
+
+class _BenchPlugin(ActionPlugin):
+
+    translations = {}
+
+    @classmethod
+    def get_translations(cls):
+        return cls.translations
+
+    def get_number_of_steps(self):
+        return 1
+
+    def get_action_body_for_step(self, step_number, action, request,
+                                 errors=None):
+        return None, u'''
+                   <h1>Benchmark action</h1>
+                   <form id="bench" method="POST" action="#">
+                       <input type="submit" name="submit" value="submit">
+                   </form>'''
+
+    def perform_action(self, action, request):
+        return
+
+
+class BenchContext(object):
+    '''
+    State shared by the benchmarks: the settings, and an app built
+    lazily with cookie sessions and an in memory actions db. The
+    `mongo_uri` is given to the app, but never queried.
+    '''
+
+    def __init__(self, mongo_uri):
+        self.settings = dict(SETTINGS, mongo_uri=mongo_uri)
+        self._app = None
+
+    def make_app(self):
+        from eduid_actions import main
+        return main({}, **self.settings)
+
+    @property
+    def app(self):
+        if self._app is None:
+            self._app = self.make_app()
+            registry_settings = self._app.registry.settings
+            registry_settings['actions_db'] = _MemoryActionDB()
+            registry_settings['action_plugins']['bench'] = _BenchPlugin
+        return self._app
+
+    def request(self, path='/', **kwargs):
+        from pyramid.request import Request
+        request = Request.blank(path, **kwargs)
+        request.registry = self.app.registry
+        return request
+
+
+def auth_params(shared_key, userid):
+    nonce = '0123456789abcdef0123'
+    timestamp = '{0:x}'.format(int(time.time()))
+    token = sha256('{0}|{1}|{2}|{3}'.format(
+        shared_key, userid, nonce, timestamp).encode('ascii')).hexdigest()
+    return token, nonce, timestamp
+
+
+@benchmark('verify_auth_token')
+def bench_verify_auth_token(ctx):
+    from eduid_actions.auth import verify_auth_token
+    key = ctx.settings['auth_shared_secret']
+    token, nonce, timestamp = auth_params(key, USERID)
+    return lambda: verify_auth_token(key, USERID, token, nonce, timestamp)
+
+
+@benchmark('locale_negotiator')
+def bench_locale_negotiator(ctx):
+    from eduid_actions.i18n import locale_negotiator
+    request = ctx.request(headers={'Accept-Language': 'sv,en;q=0.5'})
+    request.session = {}
+    return lambda: locale_negotiator(request)
+
+
+@benchmark('get_language')
+def bench_get_language(ctx):
+    request = ctx.request(headers={'Accept-Language': 'sv,en;q=0.5'})
+    plugin = _BenchPlugin()
+    return lambda: plugin.get_language(request)
+
+
+@benchmark('plugins_registry')
+def bench_plugins_registry(ctx):
+    from eduid_actions import PluginsRegistry
+    # The plugins read the settings as parsed by main()
+    settings = ctx.app.registry.settings
+    return lambda: PluginsRegistry('eduid_actions.action', settings)
+
+
+@benchmark('main')
+def bench_main(ctx):
+    return ctx.make_app
+
+
+@benchmark('session_encode_decode')
+def bench_session(ctx):
+    from eduid_actions.session import CookieSessionFactory
+    factory = CookieSessionFactory(ctx.settings)
+    data = {
+        'userid': USERID,
+        'idp_session': 'idp-session',
+        'current_action': {'_id': str(ACTION['_id']), 'action': 'bench',
+                           'user_oid': USERID, 'preference': 100,
+                           'params': {}},
+        'current_plugin': 'bench',
+        'current_step': 1,
+        'total_steps': 1,
+    }
+
+    def encode_decode():
+        factory.loads(factory.dumps(data, time.time()))
+    return encode_decode
+
+
+@benchmark('perform_action')
+def bench_perform_action(ctx):
+    from webtest import TestApp
+    testapp = TestApp(ctx.app)
+    actions_db = ctx.app.registry.settings['actions_db']
+    token, nonce, timestamp = auth_params(
+        ctx.settings['auth_shared_secret'], USERID)
+    url = '/?userid={0}&token={1}&nonce={2}&ts={3}'.format(
+        USERID, token, nonce, timestamp)
+    # The token stays valid for 15 minutes, longer than a run.
+
+    def perform_action():
+        actions_db.add_action(ACTION)
+        res = testapp.get(url, status=302)
+        res = testapp.get(res.location, status=200)
+        res = res.forms['bench'].submit('submit', status=302)
+        testapp.reset()
+    return perform_action
+
+
+def measure(func, repeat=5, min_time=0.2):
+    '''
+    Time a callable: the number of calls per run is doubled until a
+    run takes at least `min_time` seconds, and the best of `repeat`
+    runs is kept.
+
+    :param func: the callable to time
+    :param repeat: the number of runs
+    :param min_time: the minimum duration of a run, in seconds
+
+    :type func: callable
+    :type repeat: int
+    :type min_time: float
+    :return: the seconds per call, and the number of calls per run
+    :rtype: tuple
+    '''
+    number = 1
+    while True:
+        start = default_timer()
+        for i in range(number):
+            func()
+        elapsed = default_timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed
+    for i in range(repeat - 1):
+        start = default_timer()
+        for j in range(number):
+            func()
+        best = min(best, default_timer() - start)
+    return best / number, number
+
+
+def run(names, ctx, repeat=5, min_time=0.2, out=sys.stdout):
+    '''
+    Run the benchmarks with the given names.
+
+    :return: the results, by benchmark name
+    :rtype: dict
+    '''
+    results = OrderedDict()
+    for name in names:
+        func = BENCHMARKS[name](ctx)
+        func()  # warm up caches and lazy imports
+        per_call, number = measure(func, repeat=repeat, min_time=min_time)
+        results[name] = {'seconds': per_call, 'number': number}
+        out.write('{0:<24} {1:>12.1f} us  ({2} calls)\n'.format(
+            name, per_call * 1e6, number))
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compare results with a baseline.
+
+    :param results: the results of `run`
+    :param baseline: the results of a previous run
+    :param threshold: the relative slowdown tolerated, e.g. 0.2 for 20%
+
+    :type results: dict
+    :type baseline: dict
+    :type threshold: float
+    :return: the regressions, as (name, baseline seconds, seconds)
+    :rtype: list
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        if result['seconds'] > before * (1 + threshold):
+            regressions.append((name, before, result['seconds']))
+    return regressions
+
+
+def main(argv=None):
+    '''
+    Console script to run the microbenchmarks, and to save their
+    results as a baseline or compare them with one.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Run the microbenchmarks of eduid-actions')
+    parser.add_argument('names', nargs='*',
+                        help='the benchmarks to run (default all): '
+                             '{0}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--mongo-uri',
+                        default='mongodb://localhost:27017/eduid_actions',
+                        help='mongo uri for the app, it is never queried')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds per run')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='fail if slower than the baseline in FILE')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown tolerated by --compare')
+    args = parser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('Unknown benchmarks: {0}'.format(', '.join(unknown)))
+
+    ctx = BenchContext(args.mongo_uri)
+    results = run(names, ctx, repeat=args.repeat, min_time=args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as fd:
+            json.dump({'python': platform.python_version(),
+                       'results': results}, fd, indent=2)
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            sys.stdout.write('REGRESSION {0}: {1:.1f} us -> {2:.1f} us\n'.format(
+                name, before * 1e6, after * 1e6))
+        if regressions:
+            return 1
+    return 0
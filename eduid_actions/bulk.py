@@ -0,0 +1,280 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import csv
+import json
+import time
+import argparse
+from itertools import islice
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from eduid_userdb.actions import Action
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+def parse_userids(lines, fmt='ndjson'):
+    '''
+    Iterate over the user ids in a stream of lines, either NDJSON,
+    with each line holding a string or an object with a ``userid`` key,
+    or CSV, with the user id in the first column.
+    Unparseable lines yield None, so that line numbers are kept.
+
+    :param lines: the input lines
+    :param fmt: ``ndjson`` or ``csv``
+
+    :type lines: iterable
+    :type fmt: str
+    :rtype: iterator
+    '''
+    if fmt == 'csv':
+        for row in csv.reader(lines):
+            yield row[0].strip() if row else None
+        return
+    for line in lines:
+        line = line.strip()
+        if not line:
+            yield None
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        if isinstance(item, dict):
+            item = item.get('userid')
+        yield item
+
+
+class BulkEnqueuer(object):
+    '''
+    Enqueue the same action for a stream of users, in chunks of
+    unordered bulk upserts.
+
+    An action is not added for users that already have a pending action
+    of the same type and version (the ``version`` key in the params), nor
+    twice for the same user within a chunk. Each action is an upsert
+    matching on the user, type and version, so that the check and the
+    insert are a single operation in the database, and a concurrent run
+    over the same users finds the actions already inserted instead of
+    adding them again. (Only two upserts of the same action racing each
+    other could both insert, since the collection has no unique index
+    on these keys: a user may have several actions of a type, for
+    different IdP sessions.)
+    The documents are built by the `Action` of eduid_userdb, as in
+    `ActionDB.add_action`, which only inserts one action at a time.
+
+    The stream is consumed one chunk at a time, so that the producer is
+    held back by the database, and `pause` seconds are waited between
+    chunks to leave room for the live traffic.
+    '''
+
+    def __init__(self, actions_db, action_type, preference=100, params=None,
+                 chunk_size=1000, pause=0):
+        self.actions_db = actions_db
+        self.action_type = action_type
+        self.preference = preference
+        self.params = params or {}
+        self.chunk_size = chunk_size
+        self.pause = pause
+
+    def enqueue(self, userids, skip=0):
+        '''
+        Enqueue the action for the given users, yielding a progress
+        report after each chunk. The ``processed`` count in the reports
+        can be passed as `skip` to resume an interrupted run. The users
+        whose actions could not be written are counted as ``failed``,
+        and logged.
+
+        :param userids: the user ids, as strings
+        :param skip: how many user ids to skip at the start of the stream
+
+        :type userids: iterable
+        :type skip: int
+        :rtype: iterator of dict
+        '''
+        progress = {
+            'processed': skip,
+            'inserted': 0,
+            'duplicates': 0,
+            'failed': 0,
+            'invalid': 0,
+        }
+        userids = islice(userids, skip, None)
+        while True:
+            chunk = list(islice(userids, self.chunk_size))
+            if not chunk:
+                break
+            inserted, duplicates, failed, invalid = self._insert_chunk(chunk)
+            progress['processed'] += len(chunk)
+            progress['inserted'] += inserted
+            progress['duplicates'] += duplicates
+            progress['failed'] += failed
+            progress['invalid'] += invalid
+            yield dict(progress)
+            if self.pause:
+                time.sleep(self.pause)
+
+    def _insert_chunk(self, chunk):
+        user_oids = []
+        seen = set()
+        invalid = 0
+        for userid in chunk:
+            if not (userid and ObjectId.is_valid(userid)):
+                invalid += 1
+                continue
+            user_oid = ObjectId(userid)
+            if user_oid not in seen:
+                seen.add(user_oid)
+                user_oids.append(user_oid)
+
+        version = self.params.get('version')
+        requests = []
+        for user_oid in user_oids:
+            spec = {
+                'user_oid': user_oid,
+                'action': self.action_type,
+            }
+            if version is not None:
+                spec['params.version'] = version
+            update = {'$setOnInsert': self._new_fields(user_oid)}
+            requests.append(UpdateOne(spec, update, upsert=True))
+        duplicates = len(chunk) - invalid - len(requests)
+        if not requests:
+            return 0, duplicates, 0, invalid
+        failed = 0
+        try:
+            result = self.actions_db._coll.bulk_write(requests, ordered=False)
+            inserted = result.upserted_count
+        except BulkWriteError as exc:
+            inserted = exc.details.get('nUpserted', 0)
+            errors = exc.details.get('writeErrors', [])
+            failed = len(errors)
+            for error in errors:
+                logger.error('Bulk enqueue of action %s failed for %s: %s',
+                             self.action_type, user_oids[error['index']],
+                             error.get('errmsg'))
+        duplicates += len(requests) - inserted - failed
+        return inserted, duplicates, failed, invalid
+
+    def _new_fields(self, user_oid):
+        # The equalities of the spec are copied into an upserted document,
+        # so the params are set key by key, leaving out params.version,
+        # which would otherwise conflict with it.
+        doc = Action(data={
+            '_id': ObjectId(),
+            'user_oid': user_oid,
+            'action': self.action_type,
+            'preference': self.preference,
+            'params': self.params,
+        }).to_dict()
+        params = doc.pop('params')
+        if self.params.get('version') is None:
+            doc['params'] = params
+        else:
+            for key, value in params.items():
+                if key != 'version':
+                    doc['params.' + key] = value
+        return doc
+
+
+def _read_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return json.load(f)['processed']
+
+
+def _write_checkpoint(path, progress):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.rename(tmp_path, path)
+
+
+def main(argv=None):
+    '''
+    Console script to enqueue an action for the users listed in a file
+    (or in stdin), resuming from a checkpoint file if given.
+    '''
+    import sys
+    from pyramid.paster import get_appsettings, setup_logging
+    from eduid_common.config.parsers import IniConfigParser
+    from eduid_userdb.actions import ActionDB
+
+    parser = argparse.ArgumentParser(
+        description='Enqueue an action for a stream of users')
+    parser.add_argument('config_uri', help='the ini file of the actions app')
+    parser.add_argument('action', help='the type of action to enqueue')
+    parser.add_argument('--input', default='-',
+                        help='file with the user ids (default: stdin)')
+    parser.add_argument('--format', choices=('ndjson', 'csv'),
+                        default='ndjson')
+    parser.add_argument('--preference', type=int, default=100)
+    parser.add_argument('--params', type=json.loads, default={},
+                        help='the params of the action, as JSON')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--pause', type=float, default=0,
+                        help='seconds to wait between chunks')
+    parser.add_argument('--checkpoint',
+                        help='file to record progress in, and resume from')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    cp = IniConfigParser('')
+    actions_db = ActionDB(cp.read_setting_from_env(settings, 'mongo_uri'))
+
+    enqueuer = BulkEnqueuer(actions_db, args.action,
+                            preference=args.preference,
+                            params=args.params,
+                            chunk_size=args.chunk_size,
+                            pause=args.pause)
+    skip = _read_checkpoint(args.checkpoint)
+    stream = sys.stdin if args.input == '-' else open(args.input)
+    try:
+        userids = parse_userids(stream, args.format)
+        for progress in enqueuer.enqueue(userids, skip=skip):
+            if args.checkpoint is not None:
+                _write_checkpoint(args.checkpoint, progress)
+            sys.stderr.write('{processed} processed, {inserted} inserted, '
+                             '{duplicates} duplicates, {failed} failed, '
+                             '{invalid} invalid\n'
+                             .format(**progress))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return 0
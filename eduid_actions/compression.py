@@ -0,0 +1,156 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import zlib
+
+from pyramid.settings import asbool, aslist
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+DEFAULT_CONTENT_TYPES = ('text/html', 'text/css', 'text/plain',
+                         'application/javascript', 'application/json')
+
+
+def parse_accept_encoding(header):
+    '''
+    Parse an Accept-Encoding header into the acceptable codings,
+    with their quality values.
+
+    :param header: the value of the header
+    :type header: str
+    :rtype: dict
+    '''
+    codings = {}
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+
+def choose_encoding(header, available):
+    '''
+    Choose, among the `available` codings in order of preference,
+    the one most acceptable according to an Accept-Encoding header.
+
+    :param header: the value of the header
+    :param available: the codings we can produce, preferred first
+
+    :type header: str
+    :type available: list
+    :return: the chosen coding, or None for the identity
+    :rtype: str or None
+    '''
+    codings = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for coding in available:
+        quality = codings.get(coding, codings.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def gzip_compress(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compression_tween_factory(handler, registry):
+    '''
+    Tween that compresses the responses with gzip, or with brotli if it
+    is installed, as negotiated with the Accept-Encoding of the request.
+
+    Only complete (not streamed) 200 responses of one of the
+    ``compression.content_types``, of at least ``compression.min_size``
+    bytes, are compressed; responses with a max age in their
+    Cache-Control, such as the static files, are left alone.
+    '''
+    settings = registry.settings
+    min_size = int(settings.get('compression.min_size', 1024))
+    gzip_level = int(settings.get('compression.level', 6))
+    brotli_quality = int(settings.get('compression.brotli_quality', 5))
+    content_types = frozenset(aslist(settings.get(
+        'compression.content_types', ' '.join(DEFAULT_CONTENT_TYPES))))
+    available = ['gzip']
+    if brotli is not None and asbool(settings.get('compression.brotli',
+                                                  True)):
+        available.insert(0, 'br')
+
+    def compression_tween(request):
+        response = handler(request)
+        if (response.status_int != 200 or
+                response.content_type not in content_types or
+                'Content-Encoding' in response.headers or
+                response.cache_control.max_age is not None or
+                not isinstance(response.app_iter, (list, tuple))):
+            return response
+        response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+        body = response.body
+        if len(body) < min_size:
+            return response
+        coding = choose_encoding(request.headers.get('Accept-Encoding', ''),
+                                 available)
+        if coding is None:
+            return response
+        if coding == 'br':
+            compressed = brotli.compress(body, quality=brotli_quality)
+        else:
+            compressed = gzip_compress(body, gzip_level)
+        response.body = compressed
+        response.content_encoding = coding
+        return response
+
+    return compression_tween
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if asbool(settings.get('compression.enabled', False)):
+        config.add_tween(
+            'eduid_actions.compression.compression_tween_factory')
@@ -0,0 +1,126 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+
+from pyramid.request import Request
+from pyramid.response import Response
+from pyramid.renderers import render
+from pyramid.scripting import prepare
+from pyramid.settings import asbool
+
+from eduid_actions.i18n import sessionless_locale_negotiator
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+# Base url of the pages rendered with root relative urls,
+# stripped from them after rendering.
+_RELATIVE_BASE = 'http://error-pages.invalid'
+
+
+class _NullSession(dict):
+    '''
+    Empty stand-in for the session, used when rendering the static
+    error pages so that no session is ever created or loaded for them.
+    '''
+
+    def peek_flash(self, queue=''):
+        return []
+
+    def pop_flash(self, queue=''):
+        return []
+
+
+class ErrorPages(object):
+    '''
+    In memory cache of the static error pages (403, 404, 405, 500).
+
+    Each page is rendered once per language, outside of the session
+    of the request that triggered it, and afterwards served as cached
+    bytes. The urls in the pages are relative to the root of the site,
+    unless ``error_pages.base_url`` is set; they never depend on the
+    Host of the request. Since there is no session, pending flash
+    messages are not shown in the error pages, and are left for the
+    next page instead.
+    '''
+
+    def __init__(self, settings):
+        self.enabled = not asbool(settings.get('pyramid.reload_templates',
+                                               False))
+        self.max_entries = int(settings.get('error_pages.max_entries', 64))
+        self.base_url = settings.get('error_pages.base_url') or None
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def response(self, template, status, request):
+        '''
+        Return a response with the rendered error page.
+
+        :param template: the name of the error template
+        :param status: the HTTP status code of the response
+        :param request: the request that triggered the error
+
+        :type template: str
+        :type status: int
+        :type request: pyramid.request.Request
+        :rtype: pyramid.response.Response
+        '''
+        lang = sessionless_locale_negotiator(request)
+        key = (template, lang)
+        body = self._pages.get(key)
+        if body is None:
+            body = self._render(template, lang, request)
+            if self.enabled:
+                with self._lock:
+                    if len(self._pages) < self.max_entries:
+                        self._pages[key] = body
+        return Response(body=body, status=status,
+                        content_type='text/html', charset='utf-8')
+
+    def _render(self, template, lang, request):
+        settings = request.registry.settings
+        cookie = '{0}={1}'.format(settings['lang_cookie_name'], lang)
+        base_url = self.base_url or _RELATIVE_BASE
+        blank = Request.blank(request.path, base_url=base_url,
+                              headers={'Cookie': cookie})
+        blank.session = _NullSession()
+        env = prepare(request=blank, registry=request.registry)
+        try:
+            logger.debug('Rendering error page %s for language %s',
+                         template, lang)
+            html = render(template, {}, request=blank)
+        finally:
+            env['closer']()
+        if self.base_url is None:
+            html = html.replace(_RELATIVE_BASE, '')
+        return html.encode('utf-8')
@@ -30,7 +30,14 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+from jinja2.ext import Extension
+from jinja2.lexer import Token
 from pyramid.i18n import TranslationStringFactory
+from pyramid.i18n import make_localizer
+from pyramid.interfaces import ITranslationDirectories
+from pyramid.threadlocal import get_current_request
+
+from eduid_actions.user import peek_current_user
 
 translation_domain = 'eduid-actions'
 TranslationString = TranslationStringFactory(translation_domain)
@@ -45,14 +52,127 @@ def locale_negotiator(request):
     if cookie_lang and cookie_lang in available_languages:
         return cookie_lang
 
-    user = request.session.get('user')
+    # Use the user only if it has already been loaded for this request,
+    # negotiating the locale is not worth a trip to the user db.
+    user = request.session.get('user') or peek_current_user(request)
     if user:
         preferredLanguage = user.get_preferred_language()
         if preferredLanguage:
             return preferredLanguage
 
+    return _accept_language(request)
+
+
+def sessionless_locale_negotiator(request):
+    '''
+    Negotiate the locale using only the language cookie and the
+    Accept-Language header, without creating or loading a session.
+    Used for responses that must stay cheap, such as the error pages.
+    '''
+    settings = request.registry.settings
+    available_languages = settings['available_languages'].keys()
+    cookie_name = settings['lang_cookie_name']
+
+    cookie_lang = request.cookies.get(cookie_name, None)
+    if cookie_lang and cookie_lang in available_languages:
+        return cookie_lang
+
+    return _accept_language(request)
+
+
+def _accept_language(request):
+    settings = request.registry.settings
+    available_languages = settings['available_languages'].keys()
+
     locale_name = request.accept_language.best_match(available_languages)
 
     if locale_name not in available_languages:
         locale_name = settings.get('default_locale_name', 'sv')
     return locale_name
+
+
+class InlineTranslationsExtension(Extension):
+    '''
+    Jinja2 extension that replaces, at compile time, the translatable
+    strings in a template with their translations, given by the
+    ``inline_translate`` attribute of the environment.
+
+    Only ``_("literal")`` calls and ``{% trans %}`` blocks without
+    variables are inlined; anything else (and strings with ``%``, that
+    would be interpolated) is left to be translated at render time.
+    '''
+
+    def filter_stream(self, stream):
+        translate = getattr(self.environment, 'inline_translate', None)
+        tokens = list(stream)
+        if translate is None:
+            return tokens
+        result = []
+        i = 0
+        while i < len(tokens):
+            window = tokens[i:i + 7]
+            types = [t.type for t in window]
+            if types[:4] == ['name', 'lparen', 'string', 'rparen'] and \
+                    window[0].value == '_' and '%' not in window[2].value:
+                lineno = window[0].lineno
+                result.extend([
+                    Token(lineno, 'string', translate(window[2].value)),
+                    Token(lineno, 'pipe', '|'),
+                    Token(lineno, 'name', 'safe'),
+                ])
+                i += 4
+            elif types == ['block_begin', 'name', 'block_end', 'data',
+                           'block_begin', 'name', 'block_end'] and \
+                    window[1].value == 'trans' and \
+                    window[5].value == 'endtrans' and \
+                    '%' not in window[3].value:
+                result.append(Token(window[3].lineno, 'data',
+                                    translate(window[3].value)))
+                i += 7
+            else:
+                result.append(tokens[i])
+                i += 1
+        return result
+
+
+def install_inline_translations(config):
+    '''
+    Make the jinja2 environment used to render the ``.jinja2`` templates
+    compile each template once per available language, with its
+    translations inlined, and pick the variant for the locale of the
+    current request.
+
+    :param config: the configurator, once the jinja2 renderer is set up
+    :type config: pyramid.config.Configurator
+    '''
+    settings = config.registry.settings
+    environment = config.get_jinja2_environment()
+    domain = settings['jinja2.i18n.domain']
+    translation_dirs = config.registry.queryUtility(ITranslationDirectories,
+                                                    default=[])
+    variants = {}
+    for lang in settings['available_languages'].keys():
+        localizer = make_localizer(lang, translation_dirs)
+        variant = environment.overlay(
+            extensions=[InlineTranslationsExtension])
+
+        def translate(msgid, localizer=localizer):
+            return localizer.translate(msgid, domain=domain)
+
+        variant.inline_translate = translate
+        variants[lang] = variant
+
+    default_get_template = environment.get_template
+
+    def get_template(name, parent=None, globals=None):
+        request = get_current_request()
+        variant = None
+        if request is not None:
+            variant = variants.get(request.locale)
+        if variant is None:
+            return default_get_template(name, parent, globals)
+        return variant.get_template(name, parent, globals)
+
+    # Set on the instance only after the overlays are made, since
+    # overlays copy the attributes of the environment.
+    environment.get_template = get_template
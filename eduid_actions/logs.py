@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import random
+import logging
+import threading
+from hashlib import sha256
+
+from six.moves import queue
+
+logger = logging.getLogger('eduid_actions')
+
+_sample_rates = {}
+
+
+def set_sample_rates(settings):
+    '''
+    Read the sample rates of the log events from the settings, given as
+    ``logging.sample.<event> = <rate>``, with rate between 0 and 1.
+
+    :param settings: the settings
+    :type settings: dict
+    '''
+    prefix = 'logging.sample.'
+    rates = {}
+    for key, value in settings.items():
+        if key.startswith(prefix):
+            rates[key[len(prefix):]] = float(value)
+    _sample_rates.clear()
+    _sample_rates.update(rates)
+
+
+def hash_userid(userid):
+    '''
+    A short, stable pseudonym for a userid, to correlate log events
+    without logging the userid itself.
+    '''
+    if userid is None:
+        return None
+    return sha256(str(userid).encode('utf-8')).hexdigest()[:12]
+
+
+class _Event(object):
+    # Formatted only if and when a handler emits the record.
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        parts = ['event={0}'.format(_quote(self.event))]
+        for key in sorted(self.fields):
+            parts.append('{0}={1}'.format(key, _quote(self.fields[key])))
+        return ' '.join(parts)
+
+
+def _quote(value):
+    # Values with spaces, quotes or equal signs are double quoted,
+    # escaping backslashes, double quotes and line breaks.
+    value = u'{0}'.format(value)
+    if value and not any(c in value for c in u' "=\\\n\r\t'):
+        return value
+    value = value.replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+    value = value.replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+    return u'"{0}"'.format(value)
+
+
+def log_event(event, level=logging.INFO, **fields):
+    '''
+    Log a structured event, as ``event=<event> key=value ...``, with
+    the values that have spaces or quotes double quoted. Nothing is
+    built unless the level is enabled and the event passes its sample
+    rate, set with `set_sample_rates`. The fields are also set as the
+    ``event_fields`` attribute of the log record.
+
+    The ``user`` field is given as the userid, and logged as its
+    `hash_userid` pseudonym.
+
+    :param event: the name of the event
+    :param level: the logging level
+    :param fields: the fields of the event
+
+    :type event: str
+    :type level: int
+    '''
+    if not logger.isEnabledFor(level):
+        return
+    rate = _sample_rates.get(event)
+    if rate is not None and random.random() >= rate:
+        return
+    if 'user' in fields:
+        fields['user'] = hash_userid(fields['user'])
+    logger.log(level, '%s', _Event(event, fields),
+               extra={'event': event, 'event_fields': fields})
+
+
+class BackgroundHandler(logging.Handler):
+    '''
+    Handler that puts the log records in a bounded queue, and hands them
+    from a background thread to the wrapped handler, so that logging
+    never blocks on I/O. Records that don't fit in the queue are dropped
+    and counted in ``dropped``.
+    '''
+
+    def __init__(self, handler, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.handler.setFormatter(fmt)
+
+    def emit(self, record):
+        try:
+            # Merge the args and the traceback now, since they
+            # may change or be gone by the time the record is written.
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.handler.handle(record)
+            except Exception:
+                self.handler.handleError(record)
+
+    def close(self, timeout=5):
+        '''
+        Write the records left in the queue, waiting at most `timeout`
+        seconds, and close the wrapped handler.
+        '''
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+class BackgroundStreamHandler(BackgroundHandler):
+    '''
+    A `BackgroundHandler` writing to a stream, to be used from the
+    logging configuration in the ini file in place of StreamHandler::
+
+      [handler_console]
+      class = eduid_actions.logs.BackgroundStreamHandler
+      args = (sys.stderr,)
+    '''
+
+    def __init__(self, stream=None, maxsize=10000):
+        BackgroundHandler.__init__(self, logging.StreamHandler(stream),
+                                   maxsize)
@@ -0,0 +1,220 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+import signal
+import itertools
+import threading
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+def _request_key(request):
+    route = 'none'
+    if getattr(request, 'matched_route', None) is not None:
+        route = request.matched_route.name
+    plugin = 'none'
+    # Only look at an already loaded session, never create one
+    session = request.__dict__.get('session')
+    if session is not None:
+        plugin = session.get('current_plugin') or 'none'
+    return '{0}/{1}'.format(route, plugin)
+
+
+class MemoryStats(object):
+    '''
+    Allocation deltas of the sampled requests, aggregated by route and
+    plugin type. For each of them, the `max_sites` code locations with
+    the largest net allocation are kept.
+    '''
+
+    def __init__(self, max_sites=20):
+        self.max_sites = max_sites
+        # Set by the signal handler, and cleared when the report is logged
+        self.report_requested = False
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def record(self, key, before, after):
+        '''
+        Add the allocations made between two snapshots to the stats
+        of a route and plugin type.
+
+        :param key: the route and plugin type, as ``<route>/<plugin>``
+        :param before: the snapshot taken before the request
+        :param after: the snapshot taken after the request
+
+        :type key: str
+        :type before: tracemalloc.Snapshot
+        :type after: tracemalloc.Snapshot
+        '''
+        diff = after.compare_to(before, 'lineno')
+        with self._lock:
+            stats = self._stats.setdefault(key, {
+                'samples': 0, 'size_diff': 0, 'sites': {}})
+            stats['samples'] += 1
+            sites = stats['sites']
+            for stat in diff:
+                if not stat.size_diff:
+                    continue
+                stats['size_diff'] += stat.size_diff
+                site = str(stat.traceback[0])
+                size, count = sites.get(site, (0, 0))
+                sites[site] = (size + stat.size_diff,
+                               count + stat.count_diff)
+            if len(sites) > self.max_sites:
+                largest = sorted(sites.items(), key=lambda item: -item[1][0])
+                stats['sites'] = dict(largest[:self.max_sites])
+
+    def report(self, limit=10):
+        '''
+        The net allocations by route and plugin type, with their top
+        allocation sites, and the top allocation sites of the memory
+        currently traced in the process.
+
+        :param limit: the number of sites to report for each
+        :type limit: int
+        :rtype: dict
+        '''
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            routes = {}
+            for key, stats in self._stats.items():
+                sites = sorted(stats['sites'].items(),
+                               key=lambda item: -item[1][0])[:limit]
+                routes[key] = {
+                    'samples': stats['samples'],
+                    'size_diff': stats['size_diff'],
+                    'top': [{'site': site, 'size_diff': size,
+                             'count_diff': count}
+                            for site, (size, count) in sites],
+                }
+        top = self.take_snapshot().statistics('lineno')[:limit]
+        return {
+            'traced': {'current': current, 'peak': peak},
+            'routes': routes,
+            'top': [{'site': str(stat.traceback[0]), 'size': stat.size,
+                     'count': stat.count} for stat in top],
+        }
+
+
+def memory_tween_factory(handler, registry):
+    '''
+    Tween that takes a tracemalloc snapshot before and after one in
+    every ``memory.every`` requests, and adds the difference to the
+    `MemoryStats` in the ``memory_stats`` setting. Requests that are
+    not sampled only pay for a counter increment (and for the tracing
+    of their allocations by tracemalloc).
+
+    The snapshots cover the whole process, so in a threaded server the
+    difference would include the allocations of the requests served
+    meanwhile by other threads; requests are only sampled there if
+    ``memory.threaded`` is true.
+
+    The report asked for by the ``memory.signal`` signal is logged
+    here, at the start of the next request, rather than in the signal
+    handler, which could interrupt a thread holding the lock of the
+    stats.
+    '''
+    settings = registry.settings
+    every = int(settings.get('memory.every', 100))
+    threaded = asbool(settings.get('memory.threaded', False))
+    memory_stats = settings['memory_stats']
+    counter = itertools.count(1)
+    lock = threading.Lock()
+
+    def memory_tween(request):
+        if memory_stats.report_requested:
+            memory_stats.report_requested = False
+            logger.warning('Memory report: %s',
+                           json.dumps(memory_stats.report(), sort_keys=True))
+        if next(counter) % every != 0:
+            return handler(request)
+        if request.environ.get('wsgi.multithread') and not threaded:
+            return handler(request)
+        # Overlapping samples would count each other's allocations
+        if not lock.acquire(False):
+            return handler(request)
+        try:
+            before = memory_stats.take_snapshot()
+            response = handler(request)
+            after = memory_stats.take_snapshot()
+            memory_stats.record(_request_key(request), before, after)
+            return response
+        finally:
+            lock.release()
+
+    return memory_tween
+
+
+def _install_signal_handler(signame, memory_stats):
+    signum = getattr(signal, 'SIG' + signame.upper().replace('SIG', ''))
+
+    def request_report(signum, frame):
+        # Only set a flag, see memory_tween_factory
+        memory_stats.report_requested = True
+
+    signal.signal(signum, request_report)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if not asbool(settings.get('memory.enabled', False)):
+        settings['memory_stats'] = None
+        return
+    if tracemalloc is None:
+        raise ConfigurationError('memory.enabled needs tracemalloc')
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(int(settings.get('memory.frames', 1)))
+    memory_stats = MemoryStats(int(settings.get('memory.max_sites', 20)))
+    settings['memory_stats'] = memory_stats
+    if settings.get('memory.signal'):
+        _install_signal_handler(settings['memory.signal'], memory_stats)
+    config.add_tween('eduid_actions.memory.memory_tween_factory')
@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import threading
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from eduid_actions.threads import ForkSafeThread
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+class PendingActionsIndex(object):
+    '''
+    In process index of the users that have pending actions.
+
+    The index is a set of user_oids, loaded from the actions collection
+    and kept up to date by polling it every `poll_interval` seconds for
+    documents added after a watermark. The watermark is on the creation
+    time embedded in the ``_id`` of the actions, and each poll goes back
+    `overlap` seconds before the last one, to catch documents with ids
+    made on clients with slightly skewed clocks. There is no insert time
+    of our own to poll on, since actions are added by other services;
+    and an ``_id`` need not be new when the action is inserted (it may
+    be given explicitly, or the action may be restored from a backup),
+    so every `full_reload` seconds the whole index is loaded again. This
+    bounds how long such an action can be missed, and also drops the
+    users whose actions have been removed.
+
+    Removed actions are not seen by the polling; instead, when the index
+    says that a user has pending actions, the actions db is consulted
+    and the user is dropped from the index if there are none left.
+
+    A negative answer is only given from the index if it has been
+    refreshed within the last `max_lag` seconds; otherwise the actions
+    db is asked directly.
+    '''
+
+    def __init__(self, actions_db, poll_interval=1.0, max_lag=5.0,
+                 overlap=10.0, full_reload=300.0):
+        self.actions_db = actions_db
+        self.poll_interval = poll_interval
+        self.max_lag = max_lag
+        self.overlap = overlap
+        self.full_reload = full_reload
+        self._users = set()
+        self._watermark = None
+        self._loaded = 0
+        self._refreshed = 0
+        self._lock = threading.Lock()
+        self._poller = ForkSafeThread(self._poll, 'pending-actions-index',
+                                      on_fork=self._forked)
+
+    def has_pending_actions(self, userid, idp_session=None):
+        '''
+        Whether the given user has any pending action.
+
+        :param userid: the user_oid of the user
+        :param idp_session: the IdP session, if any
+
+        :type userid: str
+        :type idp_session: str
+        :rtype: bool
+        '''
+        self._poller.ensure_started()
+        user_oid = ObjectId(userid)
+        if time.time() - self._refreshed <= self.max_lag:
+            if user_oid not in self._users:
+                return False
+        action = self.actions_db.get_next_action(userid, idp_session)
+        if action is None and idp_session is None:
+            with self._lock:
+                self._users.discard(user_oid)
+        return action is not None
+
+    def refresh(self):
+        '''
+        Add to the index the users of the actions added since the
+        previous refresh; on the first call, and every `full_reload`
+        seconds, load the whole index.
+        '''
+        started = time.time()
+        full = (self._watermark is None or
+                started - self._loaded >= self.full_reload)
+        spec = {}
+        if not full:
+            since = self._watermark - timedelta(seconds=self.overlap)
+            spec = {'_id': {'$gt': ObjectId.from_datetime(since)}}
+        users = set()
+        # ActionDB only has lookups by user, so the collection is
+        # queried directly, as in the stats and the purge.
+        for doc in self.actions_db._coll.find(spec, {'user_oid': 1}):
+            users.add(doc['user_oid'])
+        with self._lock:
+            if full:
+                self._users = users
+            else:
+                self._users.update(users)
+        if full:
+            self._loaded = started
+        self._watermark = datetime.utcfromtimestamp(started)
+        self._refreshed = started
+        logger.debug('Refreshed pending actions index, %d new entries, '
+                     '%d users in total', len(users), len(self._users))
+
+    def _forked(self):
+        # The index may be stale
+        self._watermark = None
+        self._loaded = 0
+        self._refreshed = 0
+
+    def _poll(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as exc:
+                logger.warning('Could not refresh the pending actions '
+                               'index: %r', exc)
+            time.sleep(self.poll_interval)
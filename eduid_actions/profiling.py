@@ -0,0 +1,164 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import re
+import hmac
+import time
+import cProfile
+import itertools
+import threading
+from hashlib import sha256
+
+from pyramid.settings import asbool
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+PROFILE_HEADER = 'X-Actions-Profile'
+
+_UNSAFE_RE = re.compile(r'[^A-Za-z0-9_.]+')
+
+
+def sign_profile_request(secret, timestamp=None):
+    '''
+    Make a value for the X-Actions-Profile header, that asks for the
+    request carrying it to be profiled.
+
+    :param secret: the ``profiling.secret`` setting
+    :param timestamp: unixtime, defaults to now
+
+    :type secret: str
+    :type timestamp: int
+    :rtype: str
+    '''
+    if timestamp is None:
+        timestamp = int(time.time())
+    timestamp = str(timestamp)
+    mac = hmac.new(secret.encode('utf-8'), timestamp.encode('ascii'),
+                   sha256).hexdigest()
+    return '{0}.{1}'.format(timestamp, mac)
+
+
+def verify_profile_request(secret, value, max_age=300):
+    try:
+        timestamp, mac = value.split('.', 1)
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return False
+    if not -max_age < age < max_age:
+        return False
+    expected = sign_profile_request(secret, timestamp).split('.', 1)[1]
+    return hmac.compare_digest(expected.encode('ascii'),
+                               mac.encode('ascii'))
+
+
+class ProfileRing(object):
+    '''
+    Bounded set of profiles on disk, in the format of the standard
+    library profilers (readable with ``pstats``). File names start
+    with the time and end with the route and plugin type, so that
+    profiles can be grouped by globbing, and only the `max_files`
+    most recent ones are kept.
+    '''
+
+    def __init__(self, directory, max_files=200):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, profile, route, plugin):
+        name = '{0:.6f}-{1}-{2}-{3}.prof'.format(
+            time.time(), os.getpid(),
+            _UNSAFE_RE.sub('_', route), _UNSAFE_RE.sub('_', plugin))
+        profile.dump_stats(os.path.join(self.directory, name))
+        with self._lock:
+            files = sorted(f for f in os.listdir(self.directory)
+                           if f.endswith('.prof'))
+            for old in files[:-self.max_files]:
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
+
+
+def profiling_tween_factory(handler, registry):
+    '''
+    Tween that profiles a sample of the requests: one every
+    ``profiling.every`` requests (if set), and those carrying a valid
+    X-Actions-Profile header signed with ``profiling.secret`` (if set).
+    Requests that are not profiled only pay for a counter increment.
+    '''
+    settings = registry.settings
+    every = int(settings.get('profiling.every', 0))
+    secret = settings.get('profiling.secret', None)
+    ring = ProfileRing(settings['profiling.directory'],
+                       int(settings.get('profiling.max_files', 200)))
+    counter = itertools.count(1)
+
+    def profiling_tween(request):
+        sampled = every > 0 and next(counter) % every == 0
+        if not sampled:
+            header = request.headers.get(PROFILE_HEADER)
+            if not (header and secret and
+                    verify_profile_request(secret, header)):
+                return handler(request)
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return handler(request)
+        finally:
+            profile.disable()
+            route = 'none'
+            if getattr(request, 'matched_route', None) is not None:
+                route = request.matched_route.name
+            plugin = 'none'
+            # Only look at an already loaded session, never create one
+            session = request.__dict__.get('session')
+            if session is not None:
+                plugin = session.get('current_plugin') or 'none'
+            try:
+                ring.write(profile, route, plugin)
+            except Exception as exc:
+                logger.warning('Could not write profile: %r', exc)
+
+    return profiling_tween
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if asbool(settings.get('profiling.enabled', False)):
+        config.add_tween('eduid_actions.profiling.profiling_tween_factory')
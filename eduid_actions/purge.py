@@ -0,0 +1,256 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from eduid_actions.threads import ForkSafeThread
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+class ActionsPurger(object):
+    '''
+    Find and delete the actions that can no longer be performed:
+
+    * stale actions, tied to an IdP session and older than
+      `session_max_age` seconds, by which time the IdP session
+      has long expired;
+    * orphaned actions, of the types given in `orphaned_types`, whose
+      plugins have been retired.
+
+    The orphaned types are always given explicitly, rather than taken
+    from the plugins installed where the purge runs, since during a
+    deploy different hosts may have different sets of plugins.
+
+    Documents are deleted by id in batches of `batch_size`, waiting
+    `pause` seconds between batches to limit the load on the db.
+    '''
+
+    def __init__(self, actions_db, orphaned_types=(), session_max_age=86400,
+                 batch_size=500, pause=0.1):
+        self.actions_db = actions_db
+        self.orphaned_types = list(orphaned_types)
+        self.session_max_age = session_max_age
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def ensure_indexes(self):
+        self.actions_db._coll.create_index([('action', ASCENDING)],
+                                           background=True)
+
+    def stale_spec(self, now=None):
+        if now is None:
+            now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.session_max_age)
+        return {
+            '_id': {'$lt': ObjectId.from_datetime(cutoff)},
+            'session': {'$exists': True, '$ne': None},
+        }
+
+    def orphaned_spec(self):
+        return {'action': {'$in': self.orphaned_types}}
+
+    def report(self, installed=None):
+        '''
+        Count the documents that would be purged, without deleting them.
+
+        :param installed: if given, the names of the installed plugins,
+                          to also count the actions of any other type
+        :type installed: iterable or None
+
+        :return: the number of stale actions, of orphaned actions by
+                 action type, and of actions with no installed plugin
+                 by action type
+        :rtype: dict
+        '''
+        coll = self.actions_db._coll
+        report = {
+            'stale': coll.count_documents(self.stale_spec()),
+            'orphaned': self._count_by_type(self.orphaned_spec()),
+        }
+        if installed is not None:
+            spec = {'action': {'$nin': list(installed)}}
+            report['uninstalled'] = self._count_by_type(spec)
+        return report
+
+    def purge(self):
+        '''
+        Delete the stale and the orphaned actions.
+
+        :return: the number of deleted stale and orphaned actions
+        :rtype: dict
+        '''
+        return {
+            'stale': self.purge_stale(),
+            'orphaned': self.purge_orphaned(),
+        }
+
+    def purge_stale(self):
+        '''
+        Delete the stale actions.
+
+        :return: the number of deleted actions
+        :rtype: int
+        '''
+        return self._delete_in_batches(self.stale_spec())
+
+    def purge_orphaned(self):
+        '''
+        Delete the actions of the orphaned types.
+
+        :return: the number of deleted actions
+        :rtype: int
+        '''
+        if not self.orphaned_types:
+            return 0
+        return self._delete_in_batches(self.orphaned_spec())
+
+    def _count_by_type(self, spec):
+        counts = {}
+        for doc in self.actions_db._coll.find(spec, {'action': 1}):
+            counts[doc['action']] = counts.get(doc['action'], 0) + 1
+        return counts
+
+    def _delete_in_batches(self, spec):
+        coll = self.actions_db._coll
+        deleted = 0
+        while True:
+            ids = [doc['_id'] for doc in
+                   coll.find(spec, {'_id': 1}).limit(self.batch_size)]
+            if not ids:
+                break
+            result = coll.delete_many({'_id': {'$in': ids}})
+            deleted += result.deleted_count
+            if len(ids) < self.batch_size:
+                break
+            if self.pause:
+                time.sleep(self.pause)
+        return deleted
+
+
+class PurgeJob(object):
+    '''
+    Background thread that deletes the stale actions every `interval`
+    seconds. Orphaned actions are only purged by the console script.
+
+    The thread is started lazily, by `ensure_started`, on the first
+    request served by each process, so that it runs in the forked
+    workers rather than in the parent. The first run is at a random
+    point within the first interval, to spread the runs of the workers.
+    '''
+
+    def __init__(self, actions_db, interval, **kwargs):
+        self.actions_db = actions_db
+        self.interval = interval
+        self.kwargs = kwargs
+        self._thread = ForkSafeThread(self._run, 'actions-purge')
+
+    def ensure_started(self, event=None):
+        '''
+        Start the purge thread in this process, unless it is running.
+
+        :param event: the NewRequest event, when used as a subscriber
+        '''
+        self._thread.ensure_started()
+
+    def _run(self):
+        time.sleep(random.uniform(0, self.interval))
+        purger = ActionsPurger(self.actions_db, **self.kwargs)
+        while True:
+            try:
+                purged = purger.purge_stale()
+                logger.info('Purged %d stale actions', purged)
+            except Exception as exc:
+                logger.warning('Could not purge actions: %r', exc)
+            time.sleep(self.interval)
+
+
+def main(argv=None):
+    '''
+    Console script to report on, or purge, the stale and orphaned actions.
+    '''
+    from pkg_resources import iter_entry_points
+    from pyramid.paster import get_appsettings, setup_logging
+    from eduid_common.config.parsers import IniConfigParser
+    from eduid_userdb.actions import ActionDB
+
+    parser = argparse.ArgumentParser(
+        description='Purge stale and orphaned actions')
+    parser.add_argument('config_uri', help='the ini file of the actions app')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report what would be purged')
+    parser.add_argument('--orphaned', action='append', default=[],
+                        metavar='ACTION_TYPE',
+                        help='a retired action type, whose actions are '
+                             'purged (can be repeated)')
+    parser.add_argument('--session-max-age', type=int, default=86400,
+                        help='age in seconds after which actions tied to '
+                             'an IdP session are stale')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.1,
+                        help='seconds to wait between batches')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    cp = IniConfigParser('')
+    actions_db = ActionDB(cp.read_setting_from_env(settings, 'mongo_uri'))
+
+    purger = ActionsPurger(actions_db, args.orphaned,
+                           session_max_age=args.session_max_age,
+                           batch_size=args.batch_size,
+                           pause=args.pause)
+    purger.ensure_indexes()
+    if args.dry_run:
+        installed = set(ep.name for ep in
+                        iter_entry_points('eduid_actions.action'))
+        report = purger.report(installed)
+        sys.stdout.write('{0} stale actions\n'.format(report['stale']))
+        for action_type, count in sorted(report['orphaned'].items()):
+            sys.stdout.write('{0} orphaned {1} actions\n'.format(
+                count, action_type))
+        for action_type, count in sorted(report['uninstalled'].items()):
+            sys.stdout.write('{0} {1} actions, with no plugin installed '
+                             'here\n'.format(count, action_type))
+    else:
+        purged = purger.purge()
+        sys.stdout.write('Purged {0} stale and {1} orphaned actions\n'.format(
+            purged['stale'], purged['orphaned']))
+    return 0
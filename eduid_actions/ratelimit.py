@@ -0,0 +1,260 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+from eduid_actions.logs import log_event
+from eduid_actions.sentinel import redis_client
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+class TokenBuckets(object):
+    '''
+    In process token buckets, one per key, holding at most `burst`
+    tokens and refilled at `rate` tokens per second.
+
+    The number of tracked keys is bounded by `max_keys`; when the
+    limit is reached, the least recently used buckets are dropped.
+    '''
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, now=None):
+        '''
+        Take one token from the bucket for `key`.
+
+        :param key: the key identifying the bucket
+        :param now: the current time, in seconds since the epoch
+
+        :type key: str
+        :type now: float
+        :return: whether there was a token available
+        :rtype: bool
+        '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+
+class RedisTokenBuckets(TokenBuckets):
+    '''
+    Token buckets shared by all the workers through redis.
+
+    Each worker keeps its own local buckets, and counts locally the
+    tokens taken for each key. Every `sync_interval` seconds the local
+    counts are added, in a single pipeline, to per window counters in
+    redis, and the global counts are read back. Keys whose global count
+    exceeds what the rate allows for the window are rejected locally
+    until the window ends, without further round trips to redis.
+    '''
+
+    def __init__(self, client, rate, burst, window=10, sync_interval=1,
+                 prefix='eduid_actions:ratelimit', max_keys=10000):
+        super(RedisTokenBuckets, self).__init__(rate, burst, max_keys)
+        self.client = client
+        self.window = int(window)
+        self.sync_interval = float(sync_interval)
+        self.prefix = prefix
+        self.limit = self.rate * self.window + self.burst
+        self._pending = {}
+        self._blocked = {}
+        self._last_sync = 0
+        self._sync_lock = threading.Lock()
+
+    def consume(self, key, now=None):
+        if now is None:
+            now = time.time()
+        current_window = int(now // self.window)
+        if self._blocked.get(key) == current_window:
+            return False
+        if not super(RedisTokenBuckets, self).consume(key, now):
+            return False
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+        if now - self._last_sync >= self.sync_interval:
+            self.sync(now)
+        return True
+
+    def sync(self, now=None):
+        '''
+        Push the locally counted tokens to redis, and block the keys
+        that have exceeded the limit for the current window.
+        '''
+        if now is None:
+            now = time.time()
+        if not self._sync_lock.acquire(False):
+            # another thread is already syncing
+            return
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._last_sync = now
+            if not pending:
+                return
+            current_window = int(now // self.window)
+            keys = list(pending.keys())
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                redis_key = '{0}:{1}:{2}'.format(self.prefix, key,
+                                                 current_window)
+                pipe.incrby(redis_key, pending[key])
+                pipe.expire(redis_key, self.window * 2)
+            try:
+                results = pipe.execute()
+            except Exception as exc:
+                # Fail open, keep rate limiting with the local buckets only
+                logger.warning('Could not sync rate limits with redis: %r',
+                               exc)
+                return
+            blocked = dict((k, w) for k, w in self._blocked.items()
+                           if w == current_window)
+            for key, count in zip(keys, results[::2]):
+                if count > self.limit:
+                    blocked[key] = current_window
+            self._blocked = blocked
+        finally:
+            self._sync_lock.release()
+
+
+def _too_many_requests(retry_after):
+    response = Response('Too Many Requests', status='429 Too Many Requests',
+                        content_type='text/plain', charset='utf-8')
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _service_unavailable(retry_after):
+    response = Response('Service Unavailable',
+                        status='503 Service Unavailable',
+                        content_type='text/plain', charset='utf-8')
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _make_buckets(settings, rate, burst):
+    max_keys = int(settings.get('ratelimit.max_keys', 10000))
+    if settings.get('ratelimit.store', 'local') == 'redis':
+        return RedisTokenBuckets(
+            redis_client(settings), rate, burst,
+            window=int(settings.get('ratelimit.redis_window', 10)),
+            sync_interval=float(settings.get('ratelimit.redis_sync_interval',
+                                             1)),
+            max_keys=max_keys)
+    return TokenBuckets(rate, burst, max_keys=max_keys)
+
+
+def ratelimit_tween_factory(handler, registry):
+    '''
+    Tween that sheds load before any view code runs, and so before
+    any session is loaded or created.
+
+    Requests to the entry point (the ``actions`` route) are limited
+    with a token bucket per client address and another one per
+    ``userid``, and answered with a 429 when the bucket is empty.
+    All requests are subject to a cap on the number of requests
+    in flight in this worker, and answered with a 503 above it.
+    '''
+    settings = registry.settings
+    entry_path = settings.get('ratelimit.entry_path', '/')
+    retry_after = int(settings.get('ratelimit.retry_after', 5))
+    addr_header = settings.get('ratelimit.client_addr_header', None)
+    if addr_header:
+        addr_header = 'HTTP_' + addr_header.upper().replace('-', '_')
+
+    ip_buckets = _make_buckets(
+        settings,
+        float(settings.get('ratelimit.ip_rate', 5)),
+        float(settings.get('ratelimit.ip_burst', 20)))
+    user_buckets = _make_buckets(
+        settings,
+        float(settings.get('ratelimit.userid_rate', 1)),
+        float(settings.get('ratelimit.userid_burst', 5)))
+
+    max_in_flight = int(settings.get('ratelimit.max_in_flight', 0))
+    in_flight = None
+    if max_in_flight > 0:
+        in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def ratelimit_tween(request):
+        if request.path_info == entry_path:
+            client_addr = None
+            if addr_header:
+                client_addr = request.environ.get(addr_header)
+            if not client_addr:
+                client_addr = request.remote_addr
+            if not ip_buckets.consume('ip:{0}'.format(client_addr)):
+                log_event('rate_limited', address=client_addr)
+                return _too_many_requests(retry_after)
+            userid = request.GET.get('userid')
+            if userid and not user_buckets.consume('userid:' + userid):
+                log_event('rate_limited', user=userid)
+                return _too_many_requests(retry_after)
+
+        if in_flight is None:
+            return handler(request)
+        if not in_flight.acquire(False):
+            logger.warning('Shedding load, %d requests already in flight',
+                           max_in_flight)
+            return _service_unavailable(retry_after)
+        try:
+            return handler(request)
+        finally:
+            in_flight.release()
+
+    return ratelimit_tween
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if asbool(settings.get('ratelimit.enabled', False)):
+        config.add_tween('eduid_actions.ratelimit.ratelimit_tween_factory')
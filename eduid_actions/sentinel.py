@@ -0,0 +1,271 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import threading
+
+import redis
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.sentinel import Sentinel, SentinelConnectionPool
+from redis.sentinel import SentinelManagedConnection
+
+from eduid_actions.threads import ForkSafeThread
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+class SentinelMaster(object):
+    '''
+    The address of the redis master of a Sentinel service, cached for
+    the whole process.
+
+    The address is looked up once at startup, and then refreshed from a
+    background thread every `refresh_interval` seconds, so that Sentinel
+    is never asked for the master on the request path in steady state.
+    The thread is started on the first use of the address in each
+    process, so that it runs in the forked workers.
+    When a connection to the master fails, the thread is woken up and
+    keeps asking every `retry_interval` seconds until the master changes,
+    a connection succeeds, or `max_failover` seconds have passed.
+    '''
+
+    def __init__(self, sentinel, service_name, refresh_interval=10,
+                 retry_interval=0.25, max_failover=60):
+        self.sentinel = sentinel
+        self.service_name = service_name
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.max_failover = max_failover
+        self.lookups = 0
+        self.lookup_errors = 0
+        self.connection_errors = 0
+        self.failovers = 0
+        self.last_failover = None
+        self.last_failover_seconds = None
+        self._address = None
+        self._failing_since = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._poller = ForkSafeThread(self._run, 'sentinel-master')
+
+    def address(self):
+        '''
+        The cached address of the master, looked up only if it
+        has never been found.
+
+        :rtype: tuple
+        '''
+        self._poller.ensure_started()
+        address = self._address
+        if address is None:
+            address = self.discover()
+        return address
+
+    def discover(self):
+        '''
+        Ask Sentinel for the address of the master.
+
+        :rtype: tuple
+        '''
+        with self._lock:
+            self.lookups += 1
+        try:
+            address = self.sentinel.discover_master(self.service_name)
+        except Exception:
+            with self._lock:
+                self.lookup_errors += 1
+            raise
+        with self._lock:
+            if self._address is not None and address != self._address:
+                now = time.time()
+                self.failovers += 1
+                self.last_failover = now
+                if self._failing_since is not None:
+                    self.last_failover_seconds = now - self._failing_since
+                logger.warning('Redis master of %s moved from %s to %s',
+                               self.service_name, self._address, address)
+                self._failing_since = None
+            self._address = address
+        return address
+
+    def connection_failed(self):
+        '''
+        Record a failed connection to the master, and look for a new
+        master without waiting for the next refresh.
+        '''
+        with self._lock:
+            self.connection_errors += 1
+            if self._failing_since is None:
+                self._failing_since = time.time()
+        self._wakeup.set()
+
+    def connection_succeeded(self):
+        if self._failing_since is not None:
+            with self._lock:
+                self._failing_since = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'master': ':'.join(str(part)
+                                   for part in self._address or ()),
+                'lookups': self.lookups,
+                'lookup_errors': self.lookup_errors,
+                'connection_errors': self.connection_errors,
+                'failovers': self.failovers,
+                'last_failover': self.last_failover,
+                'last_failover_seconds': self.last_failover_seconds,
+                'failing': self._failing_since is not None,
+            }
+
+    def _interval(self):
+        with self._lock:
+            if self._failing_since is None:
+                return self.refresh_interval
+            if time.time() - self._failing_since > self.max_failover:
+                # Give up the fast polling, the master has not moved
+                self._failing_since = None
+                return self.refresh_interval
+            return self.retry_interval
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval())
+            self._wakeup.clear()
+            try:
+                self.discover()
+            except Exception as exc:
+                logger.warning('Could not look up the redis master of '
+                               '%s: %r', self.service_name, exc)
+
+
+class CachedSentinelConnection(SentinelManagedConnection):
+    '''
+    Connection to the master of a `CachedSentinelConnectionPool`, that
+    reports its failures to the pool's `SentinelMaster`: failed or timed
+    out connects, and connections lost while reading a response.
+    '''
+
+    def connect(self):
+        try:
+            super(CachedSentinelConnection, self).connect()
+        except (ConnectionError, TimeoutError):
+            self.connection_pool.master.connection_failed()
+            raise
+        self.connection_pool.master.connection_succeeded()
+
+    def read_response(self, *args, **kwargs):
+        # A read timeout is a slow command, not a failed master
+        try:
+            return super(CachedSentinelConnection, self).read_response(
+                *args, **kwargs)
+        except ConnectionError:
+            self.connection_pool.master.connection_failed()
+            raise
+
+
+class CachedSentinelConnectionPool(SentinelConnectionPool):
+    '''
+    Pool of connections to the master of a Sentinel service, that takes
+    the address of the master from a `SentinelMaster` instead of asking
+    Sentinel for every new connection. When the master moves, all the
+    connections to the old one are closed.
+    '''
+
+    def __init__(self, master, **kwargs):
+        kwargs.setdefault('connection_class', CachedSentinelConnection)
+        super(CachedSentinelConnectionPool, self).__init__(
+            master.service_name, master.sentinel, **kwargs)
+        self.master = master
+        self._cached_address = None
+
+    def get_master_address(self):
+        address = self.master.address()
+        if self._cached_address is None:
+            self._cached_address = address
+        elif address != self._cached_address:
+            self._cached_address = address
+            self.disconnect()
+        return address
+
+
+def make_redis_pool(settings):
+    '''
+    Make a pool of connections to the redis master of the
+    ``redis_sentinel_service_name`` service, found through the
+    ``redis_sentinel_hosts``, whose address is refreshed from the
+    first use of the pool in each process on.
+
+    :param settings: the app settings, with the redis settings parsed
+    :type settings: dict
+    :rtype: CachedSentinelConnectionPool
+    '''
+    sentinel_timeout = float(settings.get('redis_sentinel.socket_timeout',
+                                          0.5))
+    sentinel = Sentinel([(host, settings['REDIS_PORT'])
+                         for host in settings['REDIS_SENTINEL_HOSTS']],
+                        socket_timeout=sentinel_timeout)
+    master = SentinelMaster(
+        sentinel, settings['REDIS_SENTINEL_SERVICE_NAME'],
+        refresh_interval=float(settings.get(
+            'redis_sentinel.refresh_interval', 10)),
+        retry_interval=float(settings.get(
+            'redis_sentinel.retry_interval', 0.25)),
+        max_failover=float(settings.get('redis_sentinel.max_failover', 60)))
+    try:
+        master.discover()
+    except Exception as exc:
+        logger.warning('Could not look up the redis master of %s: %r',
+                       master.service_name, exc)
+    # The commands sent to the master may take longer than a lookup
+    socket_timeout = float(settings.get('redis.socket_timeout', 5))
+    return CachedSentinelConnectionPool(
+        master, db=settings['REDIS_DB'], socket_timeout=socket_timeout,
+        socket_connect_timeout=socket_timeout)
+
+
+def redis_client(settings):
+    '''
+    A redis client on the pool in the ``redis_pool`` setting, if redis is
+    reached through Sentinel, and otherwise on ``redis_host``.
+
+    :param settings: the app settings
+    :type settings: dict
+    :rtype: redis.StrictRedis
+    '''
+    pool = settings.get('redis_pool')
+    if pool is not None:
+        return redis.StrictRedis(connection_pool=pool)
+    return redis.StrictRedis(host=settings['REDIS_HOST'],
+                             port=settings['REDIS_PORT'],
+                             db=settings['REDIS_DB'])
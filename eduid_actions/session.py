@@ -1,7 +1,22 @@
+import copy
+import json
+import time
+import threading
+from collections import OrderedDict
+import base64
+import binascii
+from hashlib import sha256
+from os import urandom
+
+import redis
+import nacl.secret
+import nacl.exceptions
 from zope.interface import implementer
 from pyramid.interfaces import ISessionFactory, ISession
+from pyramid.settings import asbool
 from eduid_common.session.pyramid_session import SessionFactory as CommonSessionFactory
 from eduid_common.session.pyramid_session import Session as CommonSession
+from eduid_common.session.session import SessionManager
 
 import logging
 logger = logging.getLogger(__name__)
@@ -11,7 +26,135 @@ _EDIT_USER_EPPN = 'edit-user_eppn'
 _USER_EPPN = 'user_eppn'
 
 
-Session = implementer(ISession)(CommonSession)
+@implementer(ISession)
+class Session(CommonSession):
+    '''
+    Redis backed session, that keeps the local session cache (if any)
+    informed of every write.
+    '''
+
+    session_cache = None
+
+    def persist(self):
+        if self.session_cache is None:
+            super(Session, self).persist()
+            return
+        token = self._session.token
+        self.session_cache.writing(token)
+        try:
+            super(Session, self).persist()
+        finally:
+            self.session_cache.written(token)
+
+
+def _copy_session(base_session):
+    # Copy the data held by the session, sharing everything else
+    # (the redis connection, the encryption box, the token).
+    memo = dict((id(value), value) for value in vars(base_session).values()
+                if not isinstance(value, (dict, list)))
+    return copy.deepcopy(base_session, memo)
+
+
+class SessionCache(object):
+    '''
+    Bounded in process cache of the redis backed sessions, keyed by
+    session token.
+
+    Every write to a session increments a small version counter kept in
+    redis next to it, and a cached session is only reused while that
+    counter is unchanged, so that a session written by another worker
+    is always fetched anew. Checking the counter is a single GET of a
+    short key, instead of the fetch and decryption of the whole session.
+
+    The cache only holds sessions as fetched from redis, and every
+    request gets its own copy, so changes that are not committed never
+    reach other requests. The counter is incremented both before and
+    after a write, so that a session fetched while it is being written
+    is never reused once the write is done.
+    '''
+
+    def __init__(self, conn, max_entries, ttl,
+                 prefix='eduid_actions:session_version:'):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefix = prefix
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token, fetch):
+        '''
+        Return the session for the given token, a copy of the cached one
+        if its version in redis is unchanged, and otherwise calling `fetch`.
+
+        :param token: the session token
+        :param fetch: callable that loads the session from redis
+
+        :type token: str
+        :type fetch: callable
+        :rtype: eduid_common.session.session.RedisEncryptedSession
+        '''
+        version = self.conn.get(self.prefix + token)
+        with self._lock:
+            entry = self._entries.pop(token, None)
+            if entry is not None and entry[0] == version:
+                self._entries[token] = entry
+                cached = entry[1]
+            else:
+                cached = None
+        if cached is not None:
+            return _copy_session(cached)
+        # The version is read before fetching, so that a concurrent
+        # write makes the cached copy stale rather than hiding it.
+        base_session = fetch()
+        self._store(token, version, _copy_session(base_session))
+        return base_session
+
+    def writing(self, token):
+        '''
+        Record that the session is about to be written.
+
+        :param token: the session token
+        :type token: str
+        '''
+        self._bump(token)
+
+    def written(self, token):
+        '''
+        Record that the session has been written; the next request
+        for it fetches it from redis.
+
+        :param token: the session token
+        :type token: str
+        '''
+        self._bump(token)
+
+    def _bump(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.incr(self.prefix + token)
+        pipe.expire(self.prefix + token, self.ttl)
+        pipe.execute()
+
+    def _store(self, token, version, base_session):
+        with self._lock:
+            self._entries.pop(token, None)
+            self._entries[token] = (version, base_session)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class _PooledSessionManager(SessionManager):
+    '''
+    SessionManager on the given pool of redis connections, such as the
+    pool on the master found through Sentinel, instead of on the pool
+    it makes from the settings.
+    '''
+
+    def __init__(self, pool, cfg, **kwargs):
+        super(_PooledSessionManager, self).__init__(cfg, **kwargs)
+        self.pool = pool
 
 
 @implementer(ISessionFactory)
@@ -21,8 +164,25 @@ class SessionFactory(CommonSessionFactory):
     interface.
     It uses the SessionManager defined in eduid_common.session.session
     to create sessions backed by redis.
+
+    If ``session.local_cache_size`` is set, recently used sessions are
+    kept in a `SessionCache` in this process.
     '''
 
+    def __init__(self, settings):
+        super(SessionFactory, self).__init__(settings)
+        if settings.get('redis_pool') is not None:
+            # Redis behind Sentinel, with the master address cached
+            self.manager = _PooledSessionManager(
+                settings['redis_pool'], settings,
+                ttl=self.manager.ttl, secret=self.manager.secret)
+        self.session_cache = None
+        cache_size = int(settings.get('session.local_cache_size', 0))
+        if cache_size > 0:
+            conn = redis.StrictRedis(connection_pool=self.manager.pool)
+            self.session_cache = SessionCache(conn, cache_size,
+                                              settings['session.timeout'])
+
     def __call__(self, request):
         '''
         Create a session object for the given request.
@@ -33,13 +193,18 @@ class SessionFactory(CommonSessionFactory):
         :return: the session
         :rtype: Session
         '''
-        self.request = request
+        # No per request state is kept on the factory, since a single
+        # instance serves all the requests in the process concurrently.
         settings = request.registry.settings
         session_name = settings.get('session.key')
         cookies = request.cookies
         token = cookies.get(session_name, None)
         if token is not None:
-            base_session = self.manager.get_session(token=token)
+            if self.session_cache is not None:
+                base_session = self.session_cache.get(
+                    token, lambda: self.manager.get_session(token=token))
+            else:
+                base_session = self.manager.get_session(token=token)
             session = Session(request, base_session)
         else:
             base_session = self.manager.get_session(data={})
@@ -47,4 +212,198 @@ class SessionFactory(CommonSessionFactory):
             base_session.commit()
             session = Session(request, base_session, new=True)
             session.set_cookie()
+        session.session_cache = self.session_cache
         return session
+
+
+def _mutates(method):
+    def wrapped(self, *args, **kwargs):
+        self._dirty = True
+        return method(self, *args, **kwargs)
+    wrapped.__name__ = method.__name__
+    wrapped.__doc__ = method.__doc__
+    return wrapped
+
+
+@implementer(ISession)
+class CookieSession(dict):
+    '''
+    Session that keeps all its data in an authenticated and encrypted
+    cookie, so that no server side storage is needed.
+
+    It is meant for the small amount of state needed by the actions
+    flow (userid, idp_session, current action, plugin and steps);
+    the whole session is serialized as JSON, so its values must be
+    JSON serializable.
+    '''
+
+    def __init__(self, request, factory, data=None, created=None, new=False):
+        super(CookieSession, self).__init__(data or {})
+        self.request = request
+        self.factory = factory
+        self.created = created if created is not None else time.time()
+        self.new = new
+        self._dirty = new
+        self._invalidated = False
+        request.add_response_callback(self._set_cookie_callback)
+
+    __setitem__ = _mutates(dict.__setitem__)
+    __delitem__ = _mutates(dict.__delitem__)
+    clear = _mutates(dict.clear)
+    pop = _mutates(dict.pop)
+    popitem = _mutates(dict.popitem)
+    setdefault = _mutates(dict.setdefault)
+    update = _mutates(dict.update)
+
+    def changed(self):
+        self._dirty = True
+
+    def invalidate(self):
+        self.clear()
+        self._invalidated = True
+
+    def persist(self):
+        '''
+        Kept for compatibility with the redis backed sessions;
+        the cookie is written when the response is sent.
+        '''
+        self._dirty = True
+
+    def flash(self, msg, queue='', allow_duplicate=True):
+        storage = self.setdefault('_f_' + queue, [])
+        if allow_duplicate or (msg not in storage):
+            storage.append(msg)
+            self.changed()
+
+    def pop_flash(self, queue=''):
+        # Only a queue with messages marks the session as changed
+        storage = dict.pop(self, '_f_' + queue, [])
+        if storage:
+            self.changed()
+        return storage
+
+    def peek_flash(self, queue=''):
+        storage = self.get('_f_' + queue, [])
+        return storage
+
+    def new_csrf_token(self):
+        token = binascii.hexlify(urandom(20)).decode('ascii')
+        self['_csrft_'] = token
+        return token
+
+    def get_csrf_token(self):
+        token = self.get('_csrft_', None)
+        if token is None:
+            token = self.new_csrf_token()
+        return token
+
+    def _set_cookie_callback(self, request, response):
+        if self._invalidated:
+            response.delete_cookie(self.factory.cookie_name,
+                                   path=self.factory.cookie_path,
+                                   domain=self.factory.cookie_domain)
+            return
+        now = time.time()
+        if not self._dirty and now - self.created < self.factory.timeout / 2:
+            return
+        self.created = now
+        cookie_value = self.factory.dumps(dict(self), now)
+        if len(cookie_value) > 4000:
+            logger.warning('Session cookie is %d bytes long, browsers '
+                           'may drop it', len(cookie_value))
+        response.set_cookie(self.factory.cookie_name,
+                            value=cookie_value,
+                            max_age=self.factory.max_age,
+                            path=self.factory.cookie_path,
+                            domain=self.factory.cookie_domain,
+                            secure=self.factory.secure,
+                            httponly=self.factory.httponly)
+
+
+@implementer(ISessionFactory)
+class CookieSessionFactory(object):
+    '''
+    Session factory implementing the pyramid.interfaces.ISessionFactory
+    interface, for sessions that keep their data in an encrypted cookie
+    (see `CookieSession`) instead of in redis.
+
+    The encryption key is derived from the ``session.secret`` setting,
+    and the sessions expire after ``session.timeout`` seconds without
+    being written.
+    '''
+
+    def __init__(self, settings):
+        secret = settings['session.secret']
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        self.box = nacl.secret.SecretBox(sha256(secret).digest())
+        self.cookie_name = settings.get('session.key')
+        self.cookie_path = settings.get('session.cookie_path', '/')
+        self.cookie_domain = settings.get('session.cookie_domain', None)
+        self.secure = asbool(settings.get('session.secure', False))
+        self.httponly = asbool(settings.get('session.httponly', True))
+        self.max_age = settings.get('session.cookie_max_age', None)
+        if self.max_age is not None:
+            self.max_age = int(self.max_age)
+        self.timeout = int(settings.get('session.timeout', 3600))
+
+    def dumps(self, data, timestamp):
+        '''
+        Serialize, timestamp and encrypt the session data.
+
+        :param data: the session data
+        :param timestamp: the time at which the data is written
+
+        :type data: dict
+        :type timestamp: float
+        :rtype: str
+        '''
+        payload = json.dumps({'t': timestamp, 'd': data},
+                             separators=(',', ':')).encode('utf-8')
+        encrypted = self.box.encrypt(payload)
+        return base64.urlsafe_b64encode(encrypted).decode('ascii')
+
+    def loads(self, value, now=None):
+        '''
+        Decrypt and deserialize a cookie value made by `dumps`.
+
+        :param value: the cookie value
+        :param now: the current time, in seconds since the epoch
+
+        :type value: str
+        :type now: float
+        :return: the session data and creation time, or None if the
+                 cookie is invalid or expired
+        :rtype: tuple or None
+        '''
+        if now is None:
+            now = time.time()
+        try:
+            encrypted = base64.urlsafe_b64decode(value.encode('ascii'))
+            payload = json.loads(self.box.decrypt(encrypted).decode('utf-8'))
+        except (ValueError, TypeError, binascii.Error,
+                nacl.exceptions.CryptoError):
+            logger.info('Discarding an invalid session cookie')
+            return None
+        if now - payload['t'] > self.timeout:
+            logger.debug('Discarding an expired session cookie')
+            return None
+        return payload['d'], payload['t']
+
+    def __call__(self, request):
+        '''
+        Create a session object for the given request.
+
+        :param request: the request
+        :type request: pyramid.request.Request
+
+        :return: the session
+        :rtype: CookieSession
+        '''
+        value = request.cookies.get(self.cookie_name, None)
+        if value is not None:
+            loaded = self.loads(value)
+            if loaded is not None:
+                data, created = loaded
+                return CookieSession(request, self, data, created)
+        return CookieSession(request, self, new=True)
@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+AGE_BUCKETS = (
+    ('1h', timedelta(hours=1)),
+    ('1d', timedelta(days=1)),
+    ('7d', timedelta(days=7)),
+    ('30d', timedelta(days=30)),
+)
+
+
+AGE_LABELS = [label for label, age in AGE_BUCKETS] + ['older']
+
+
+def _age_expression(now):
+    # Nested $cond comparing the _id with ObjectIds made from the bucket
+    # limits, since older MongoDB versions can't convert ids to dates.
+    # It gives the index of the bucket in AGE_LABELS, to sort on.
+    expression = len(AGE_BUCKETS)
+    for index in reversed(range(len(AGE_BUCKETS))):
+        boundary = ObjectId.from_datetime(now - AGE_BUCKETS[index][1])
+        expression = {'$cond': [{'$gte': ['$_id', boundary]},
+                                index, expression]}
+    return expression
+
+
+class QueueStats(object):
+    '''
+    Statistics of the pending actions, counted by action type,
+    preference and age with an aggregation pipeline run in the db.
+
+    The results are kept for `cache_ttl` seconds, and only one
+    thread at a time recomputes them, so that frequent polling
+    does not cause repeated scans of the collection.
+    '''
+
+    def __init__(self, actions_db, cache_ttl=60):
+        self.actions_db = actions_db
+        self.cache_ttl = cache_ttl
+        self._cached = None
+        self._computed = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''
+        Return the statistics, from the cache if they are recent enough.
+
+        :return: the counts by action type, preference and age, the
+                 totals by action type, and the time of computation
+        :rtype: dict
+        '''
+        if self._cached is not None and \
+                time.time() - self._computed < self.cache_ttl:
+            return self._cached
+        with self._lock:
+            if self._cached is None or \
+                    time.time() - self._computed >= self.cache_ttl:
+                self._cached = self.compute()
+                self._computed = time.time()
+        return self._cached
+
+    def compute(self, now=None):
+        if now is None:
+            now = datetime.utcnow()
+        pipeline = [
+            {'$group': {
+                '_id': {
+                    'action': '$action',
+                    'preference': '$preference',
+                    'age': _age_expression(now),
+                },
+                'count': {'$sum': 1},
+            }},
+            {'$sort': {'_id.action': 1,
+                       '_id.preference': 1,
+                       '_id.age': 1}},
+        ]
+        cursor = self.actions_db._coll.aggregate(pipeline,
+                                                 allowDiskUse=True)
+        breakdown = []
+        totals = {}
+        for doc in cursor:
+            group = doc['_id']
+            breakdown.append({
+                'action': group['action'],
+                'preference': group['preference'],
+                'age': AGE_LABELS[group['age']],
+                'count': doc['count'],
+            })
+            totals[group['action']] = totals.get(group['action'], 0) + \
+                doc['count']
+        return {
+            'computed_at': now.isoformat(),
+            'totals': totals,
+            'breakdown': breakdown,
+        }
+
+
+def main(argv=None):
+    '''
+    Console script to print the statistics of the pending actions.
+    '''
+    from pyramid.paster import get_appsettings, setup_logging
+    from eduid_common.config.parsers import IniConfigParser
+    from eduid_userdb.actions import ActionDB
+
+    parser = argparse.ArgumentParser(
+        description='Statistics of the pending actions')
+    parser.add_argument('config_uri', help='the ini file of the actions app')
+    parser.add_argument('--json', action='store_true',
+                        help='print the statistics as JSON')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    cp = IniConfigParser('')
+    actions_db = ActionDB(cp.read_setting_from_env(settings, 'mongo_uri'))
+
+    stats = QueueStats(actions_db).compute()
+    if args.json:
+        json.dump(stats, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 0
+    row = '{0:<20} {1:>10} {2:>6} {3:>10}\n'
+    sys.stdout.write(row.format('action', 'preference', 'age', 'count'))
+    for item in stats['breakdown']:
+        sys.stdout.write(row.format(item['action'], item['preference'],
+                                    item['age'], item['count']))
+    for action_type, count in sorted(stats['totals'].items()):
+        sys.stdout.write('{0} total: {1}\n'.format(action_type, count))
+    return 0
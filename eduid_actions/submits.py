@@ -0,0 +1,154 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import binascii
+import threading
+from os import urandom
+from hashlib import sha256
+
+from pyramid.settings import asbool
+
+from eduid_actions.sentinel import redis_client
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+class SubmitGuard(object):
+    '''
+    Suppress duplicate submissions of a step of an action, such as
+    those produced by a double click or a browser retry.
+
+    The first request with a given key runs, and any duplicate that
+    arrives within `ttl` seconds is told so straight away, without
+    waiting for the first one to finish, so that it can be answered
+    with a redirect to the current state of the actions. Submissions
+    served by the same worker are remembered in process; if a redis
+    `client` is given, a short lived lock is also kept in redis, for
+    the duplicates served by other workers.
+    '''
+
+    def __init__(self, client=None, ttl=30, prefix='eduid_actions:submit'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._submits = {}
+        self._lock = threading.Lock()
+
+    def key(self, userid, form, params):
+        '''
+        The key of a submission: the same form, submitted by the same
+        user with the same params.
+
+        :param userid: the id of the user
+        :param form: what identifies the rendered form, such as the
+                     token of the step it was rendered for
+        :param params: the POSTed params
+
+        :type userid: str
+        :type form: str
+        :type params: webob.multidict.MultiDict
+        :rtype: str
+        '''
+        digest = sha256()
+        for name, value in sorted(params.items()):
+            digest.update(u'{0}={1}\n'.format(name, value).encode('utf-8'))
+        return '{0}:{1}:{2}'.format(userid, form, digest.hexdigest())
+
+    def run(self, key, perform):
+        '''
+        Call `perform`, unless a submission with the same key is or
+        was recently being performed.
+
+        :param key: the key of the submission, see `key`
+        :param perform: callable returning the response to the submission
+
+        :type key: str
+        :type perform: callable
+        :return: the response, or None if the submission is a duplicate
+        :rtype: pyramid.response.Response or None
+        '''
+        now = time.time()
+        with self._lock:
+            if len(self._submits) > 1000:
+                self._expire(now)
+            if self._submits.get(key, 0) > now:
+                logger.info('Duplicate submission %s', key)
+                return None
+            self._submits[key] = now + self.ttl
+
+        if self.client is not None and not self._acquire(key):
+            logger.info('Duplicate submission %s in another worker', key)
+            return None
+        try:
+            return perform()
+        except Exception:
+            # Let the user try again
+            with self._lock:
+                self._submits.pop(key, None)
+            self._release(key)
+            raise
+
+    def _expire(self, now):
+        for key in [k for k, e in self._submits.items() if e <= now]:
+            del self._submits[key]
+
+    def _acquire(self, key):
+        token = binascii.hexlify(urandom(8))
+        try:
+            return bool(self.client.set(self.prefix + ':lock:' + key, token,
+                                        nx=True, px=int(self.ttl * 1000)))
+        except Exception as exc:
+            logger.warning('Could not lock submission in redis: %r', exc)
+            return True
+
+    def _release(self, key):
+        if self.client is None:
+            return
+        try:
+            self.client.delete(self.prefix + ':lock:' + key)
+        except Exception as exc:
+            logger.warning('Could not unlock submission in redis: %r', exc)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if not asbool(settings.get('submit_guard.enabled', False)):
+        settings['submit_guard'] = None
+        return
+    client = None
+    if settings.get('submit_guard.store', 'local') == 'redis':
+        client = redis_client(settings)
+    settings['submit_guard'] = SubmitGuard(
+        client,
+        ttl=float(settings.get('submit_guard.ttl', 30)))
@@ -32,8 +32,11 @@
 
 __author__ = 'eperez'
 
+import os
 import copy
+from uuid import uuid4
 
+from bson import ObjectId
 from mock import patch
 from webtest import TestApp
 
@@ -76,6 +79,16 @@ _SETTINGS = {
     }
 
 
+DUMMY_ACTION = {
+        '_id': ObjectId('234567890123456789012301'),
+        'user_oid': ObjectId('123467890123456789014567'),
+        'action': 'dummy',
+        'preference': 100,
+        'params': {
+            }
+        }
+
+
 class DummyActionPlugin(ActionPlugin):
 
     translations = {}
@@ -117,6 +130,75 @@ class DummyActionPlugin2(DummyActionPlugin):
     _steps = 2
 
 
+class DummyActionPluginSingleRequest(DummyActionPlugin):
+
+    _steps = 2
+    single_request_steps = True
+
+    def get_action_body_for_all_steps(self, action, request, errors=None,
+                                      step=1):
+        return None, u'''
+                   <h1>Dummy action, step {0} first</h1>
+                   <form id="dummy" method="POST" action="#">
+                       <fieldset id="step1"></fieldset>
+                       <fieldset id="step2">
+                           <input type="text" name="field" value="">
+                       </fieldset>
+                       <input type="submit" name="submit" value="submit">
+                   </form>'''.format(step)
+
+    def perform_action(self, action, request):
+        if not request.POST.get('field'):
+            raise self.ValidationError({'field': u'Required'}, step=2)
+
+
+class DummyActionPluginPrefetch(DummyActionPlugin1):
+
+    def prefetch(self, action, request):
+        return {
+            'first': lambda: u'first-loaded',
+            'second': lambda: u'second-loaded',
+        }
+
+    def get_action_body_for_step(self, step_number, action, request, errors=None):
+        return None, u'''
+                   <h1>{0} {1}</h1>
+                   <form id="dummy" method="POST" action="#">
+                       <input type="submit" name="submit" value="submit">
+                   </form>'''.format(self.prefetched['first'],
+                                          self.prefetched['second'])
+
+
+class DummyActionPluginUser(DummyActionPlugin1):
+
+    def get_action_body_for_step(self, step_number, action, request, errors=None):
+        request.current_user
+        request.current_user
+        return super(DummyActionPluginUser, self).get_action_body_for_step(
+            step_number, action, request, errors=errors)
+
+    def perform_action(self, action, request):
+        request.current_user
+        # pretend that the user has been written
+        request.invalidate_current_user()
+        request.current_user
+
+
+class DummyActionPluginEcho(DummyActionPlugin1):
+
+    def get_action_body_for_step(self, step_number, action, request, errors=None):
+        return None, u'''
+                   <h1>Dummy action for {0} by {1}</h1>
+                   <form id="dummy" method="POST" action="#">
+                       <input type="submit" name="submit" value="submit">
+                   </form>'''.format(action.user_id,
+                                          request.session['userid'])
+
+    def perform_action(self, action, request):
+        if str(action.user_id) != request.session['userid']:
+            raise self.ActionError(u'Crossed sessions')
+
+
 class FunctionalTestCase(MongoTestCase):
     """TestCase with an embedded MongoDB temporary instance.
 
@@ -125,8 +207,34 @@ class FunctionalTestCase(MongoTestCase):
 
     A test can access the connection using the attribute `conn`.
     A test can access the port using the attribute `port`
+
+    The settings of the app are the defaults updated with the
+    `app_settings` of the class.
+
+    Each test gets a new app, with its own MongoDB database. Classes
+    whose tests do not depend on state kept in the app (caches, counters,
+    buffers) can set `shared_app` to True, to build the app once for the
+    class and set of settings, and reuse it in the following tests of the
+    class; the database is then shared by the class, and the actions are
+    dropped after each test.
+
+    With ``EDUID_ACTIONS_TEST_SESSIONS=cookie`` in the environment, the
+    tests that don't choose a session backend use cookie sessions, and
+    no redis instance is started.
+
+    The test cases can be split among processes, to run the suite in
+    parallel with ``nosetests --processes=<n>``; every process gets its
+    own temporary instances of MongoDB and redis.
     """
 
+    _multiprocess_can_split_ = True
+
+    shared_app = False
+
+    app_settings = {}
+
+    _apps = {}
+
     def setUp(self):
 
         settings = copy.deepcopy(_SETTINGS)
@@ -135,25 +243,30 @@ class FunctionalTestCase(MongoTestCase):
             self.settings = settings
         else:
             self.settings.update(settings)
+        self.settings.update(copy.deepcopy(self.app_settings))
 
         super(FunctionalTestCase, self).setUp(celery, get_attribute_manager)
 
-        settings['mongo_uri'] = self.tmp_db.get_uri('eduid_actions_test')
-        self.redis_instance = RedisTemporaryInstance.get_instance()
-        self.settings['redis_host'] = 'localhost'
-        self.settings['redis_port'] = self.redis_instance._port
-        self.settings['redis_db'] = '0'
-
-        app = main({}, **self.settings)
+        if self.shared_app:
+            self.db_name = 'eduid_actions_test_' + type(self).__name__
+        else:
+            self.db_name = 'eduid_actions_test_' + uuid4().hex
+        self.settings['mongo_uri'] = self.tmp_db.get_uri(self.db_name)
+        if 'session.backend' not in self.settings:
+            self.settings['session.backend'] = os.environ.get(
+                'EDUID_ACTIONS_TEST_SESSIONS', 'redis')
+        if self.settings['session.backend'] == 'redis':
+            self.redis_instance = RedisTemporaryInstance.get_instance()
+            self.settings['redis_host'] = 'localhost'
+            self.settings['redis_port'] = self.redis_instance._port
+            self.settings['redis_db'] = '0'
+
+        app = self._get_app()
 
         self.actions_db = app.registry.settings['actions_db']
         self.actions_db._drop_whole_collection()
 
         self.testapp = TestApp(app)
-        app = self.testapp.app
-        app.registry.settings['action_plugins']['dummy'] = DummyActionPlugin1
-        app.registry.settings['action_plugins']['dummy2'] = DummyActionPlugin1
-        app.registry.settings['action_plugins']['dummy_2steps'] = DummyActionPlugin2
 
         def mock_verify_auth_token(*args, **kwargs):
             if args[1] == 'fail_verify':
@@ -164,8 +277,34 @@ class FunctionalTestCase(MongoTestCase):
         self.patcher = patch.object(views, 'verify_auth_token', **mock_config)
         self.patcher.start()
 
+    def _get_app(self):
+        cls = type(self)
+        key = repr(sorted(self.settings.items()))
+        if self.shared_app and cls in self._apps:
+            cached_key, app = self._apps[cls]
+            if cached_key == key:
+                return app
+        app = main({}, **self.settings)
+        plugins = app.registry.settings['action_plugins']
+        plugins['dummy'] = DummyActionPlugin1
+        plugins['dummy2'] = DummyActionPlugin1
+        plugins['dummy_2steps'] = DummyActionPlugin2
+        plugins['dummy_single'] = DummyActionPluginSingleRequest
+        plugins['dummy_prefetch'] = DummyActionPluginPrefetch
+        plugins['dummy_user'] = DummyActionPluginUser
+        plugins['dummy_echo'] = DummyActionPluginEcho
+        if self.shared_app:
+            # Only the app of the running class is kept
+            self._apps.clear()
+            self._apps[cls] = (key, app)
+        return app
+
     def tearDown(self):
         super(FunctionalTestCase, self).tearDown()
-        self.actions_db._drop_whole_collection()
+        if self.shared_app:
+            self.actions_db._drop_whole_collection()
+        else:
+            client = self.actions_db._coll.database.client
+            client.drop_database(self.db_name)
         self.testapp.reset()
         self.patcher.stop()
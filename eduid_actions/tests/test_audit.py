@@ -0,0 +1,196 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from eduid_userdb.actions import Action
+from eduid_actions.audit import AuditLog, AuditEvent, JSONLinesAuditSink
+from eduid_actions.audit import STARTED, FINISHED, ABORTED, REMOVED
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+
+class _ListSink(object):
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    def write(self, events):
+        if self.fail:
+            raise IOError('sink down')
+        self.batches.append(events)
+
+
+class AuditLogTests(TestCase):
+
+    def _event(self, event_type=STARTED):
+        return AuditEvent(event_type, Action(data=DUMMY_ACTION), step=1)
+
+    def test_batches(self):
+        sink = _ListSink()
+        audit_log = AuditLog(sink, batch_size=2)
+        for i in range(5):
+            audit_log.record(self._event())
+        self.assertEqual(sink.batches, [])
+        audit_log.flush()
+        self.assertEqual([len(b) for b in sink.batches], [2, 2, 1])
+        self.assertEqual(audit_log.stats()['written'], 5)
+
+    def test_bounded(self):
+        audit_log = AuditLog(_ListSink(), max_events=3)
+        for i in range(5):
+            audit_log.record(self._event())
+        stats = audit_log.stats()
+        self.assertEqual(stats['pending'], 3)
+        self.assertEqual(stats['dropped'], 2)
+
+    def test_sink_failure(self):
+        audit_log = AuditLog(_ListSink(fail=True), batch_size=2)
+        for i in range(3):
+            audit_log.record(self._event())
+        audit_log.flush()
+        stats = audit_log.stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['failed'], 3)
+
+    def test_writer_started_per_process(self):
+        audit_log = AuditLog(_ListSink())
+        with patch('eduid_actions.threads.threading.Thread') as thread:
+            audit_log.record(self._event())
+            audit_log.record(self._event())
+            self.assertEqual(thread.call_count, 1)
+            # as after a fork
+            audit_log._writer.pid = -1
+            audit_log.record(self._event())
+            self.assertEqual(thread.call_count, 2)
+        self.assertEqual(audit_log.stats()['pending'], 1)
+
+    def test_unknown_event(self):
+        self.assertRaises(ValueError, self._event, 'exploded')
+
+    def test_jsonlines_sink(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'audit.jsonl')
+            sink = JSONLinesAuditSink(path)
+            sink.write([self._event(STARTED)])
+            sink.write([self._event(FINISHED)])
+            with open(path) as fd:
+                events = [json.loads(line) for line in fd]
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual([e['event_type'] for e in events],
+                         [STARTED, FINISHED])
+        self.assertEqual(events[0]['user_oid'], str(DUMMY_ACTION['user_oid']))
+        self.assertEqual(events[0]['action_type'], 'dummy')
+
+
+class AuditTests(FunctionalTestCase):
+
+    app_settings = {
+        'audit.sink': 'mongo',
+        'internal_api_secret': 'internal-secret',
+    }
+
+    def setUp(self, *args, **kwargs):
+        super(AuditTests, self).setUp(*args, **kwargs)
+        self.audit_coll = self.actions_db._coll.database['actions_audit']
+
+    def test_stats(self):
+        self.testapp.app.registry.settings['audit_log'].dropped = 2
+        res = self.testapp.get('/internal/stats',
+                               headers={'X-Internal-Secret': 'internal-secret'})
+        self.assertEqual(res.json['audit'], {
+            'pending': 0,
+            'written': 0,
+            'dropped': 2,
+            'failed': 0,
+        })
+
+    def _events(self):
+        self.testapp.app.registry.settings['audit_log'].flush()
+        return [(doc['event_type'], doc['action_type'])
+                for doc in self.audit_coll.find().sort('_id', 1)]
+
+    def test_action_finished(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        res = self.testapp.get(res.location)
+        res.forms['dummy'].submit('submit')
+        self.assertEqual(self._events(),
+                         [(STARTED, 'dummy'), (FINISHED, 'dummy')])
+        doc = self.audit_coll.find_one({'event_type': FINISHED})
+        self.assertEqual(doc['user_oid'], DUMMY_ACTION['user_oid'])
+        self.assertEqual(doc['action_id'], DUMMY_ACTION['_id'])
+
+    def test_action_removed(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        res = self.testapp.get(res.location)
+        res.forms['dummy'].submit('reject')
+        self.assertEqual([e for e, a in self._events()],
+                         [STARTED, ABORTED, REMOVED])
+
+    def test_started_once(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        location = res.location
+        self.testapp.get(location)
+        res = self.testapp.get(location)
+        res.forms['dummy'].submit('submit')
+        self.assertEqual([e for e, a in self._events()],
+                         [STARTED, FINISHED])
+
+    def test_action_updated(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        res = self.testapp.get(res.location)
+        with patch('eduid_actions.testing.DummyActionPlugin.perform_action',
+                   return_value=Action(data=DUMMY_ACTION)):
+            res.forms['dummy'].submit('submit')
+        self.assertEqual([e for e, a in self._events()], [STARTED])
+        self.assertEqual(self.actions_db.db_count(), 1)
@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from unittest import TestCase
+
+from six import StringIO
+
+from eduid_actions.benchmarks import BENCHMARKS, BenchContext
+from eduid_actions.benchmarks import measure, compare, run
+from eduid_actions.testing import FunctionalTestCase
+
+
+class BenchmarksTests(TestCase):
+
+    def test_measure(self):
+        calls = []
+        per_call, number = measure(lambda: calls.append(1),
+                                   repeat=3, min_time=0.01)
+        self.assertGreater(number, 1)
+        # the calibration runs, then the two remaining runs
+        self.assertEqual(len(calls), (2 * number - 1) + 2 * number)
+        self.assertGreater(per_call, 0)
+
+    def test_compare(self):
+        baseline = {
+            'a': {'seconds': 1.0, 'number': 10},
+            'b': {'seconds': 1.0, 'number': 10},
+        }
+        results = {
+            'a': {'seconds': 1.1, 'number': 10},
+            'b': {'seconds': 1.5, 'number': 10},
+            'c': {'seconds': 9.0, 'number': 10},
+        }
+        self.assertEqual(compare(results, baseline, 0.2), [('b', 1.0, 1.5)])
+        self.assertEqual(compare(results, baseline, 0.5), [])
+
+
+class RunBenchmarksTests(FunctionalTestCase):
+
+    def test_run_all(self):
+        ctx = BenchContext(self.settings['mongo_uri'])
+        out = StringIO()
+        results = run(list(BENCHMARKS), ctx, repeat=1, min_time=0, out=out)
+        self.assertEqual(list(results), list(BENCHMARKS))
+        for name, result in results.items():
+            self.assertEqual(result['number'], 1)
+            self.assertIn(name, out.getvalue())
@@ -0,0 +1,161 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+
+from bson import ObjectId
+from mock import patch
+from pymongo.errors import BulkWriteError
+
+from eduid_actions.bulk import BulkEnqueuer, parse_userids
+from eduid_actions.testing import FunctionalTestCase
+
+
+TOU_ACTION = {
+        '_id': ObjectId('234567890123456789012301'),
+        'user_oid': ObjectId('123467890123456789014567'),
+        'action': 'tou',
+        'preference': 100,
+        'params': {
+            'version': '2018-v1'
+            }
+        }
+
+HEADERS = {'X-Internal-Secret': 'internal-secret'}
+
+
+class BulkEnqueueTests(FunctionalTestCase):
+
+    # No state is kept in the app
+    shared_app = True
+
+    app_settings = {
+        'internal_api_secret': 'internal-secret',
+        'bulk_enqueue.chunk_size': 2,
+    }
+
+    def test_parse_userids(self):
+        lines = ['"123467890123456789014567"\n',
+                 '{"userid": "123467890123456789014568"}\n',
+                 'garbage\n']
+        self.assertEqual(list(parse_userids(lines)),
+                         ['123467890123456789014567',
+                          '123467890123456789014568',
+                          None])
+        lines = ['123467890123456789014567,foo\n']
+        self.assertEqual(list(parse_userids(lines, 'csv')),
+                         ['123467890123456789014567'])
+
+    def test_bulk_enqueue(self):
+        self.actions_db.add_action(data=TOU_ACTION)
+        body = '\n'.join([
+            '"123467890123456789014567"',
+            '"123467890123456789014568"',
+            '"123467890123456789014568"',
+            '"not-an-oid"',
+            '"123467890123456789014569"',
+        ])
+        url = ('/internal/bulk-enqueue?action=tou'
+               '&params={"version":"2018-v1"}')
+        res = self.testapp.post(url, body, headers=HEADERS)
+        progress = [json.loads(line) for line in res.body.splitlines()]
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(progress[-1], {
+            'processed': 5,
+            'inserted': 2,
+            'duplicates': 2,
+            'failed': 0,
+            'invalid': 1,
+        })
+        self.assertEqual(self.actions_db.db_count(), 3)
+
+    def test_bulk_enqueue_resume(self):
+        body = '\n'.join([
+            '"123467890123456789014567"',
+            '"123467890123456789014568"',
+        ])
+        url = '/internal/bulk-enqueue?action=tou&skip=1'
+        res = self.testapp.post(url, body, headers=HEADERS)
+        progress = json.loads(res.body.splitlines()[-1])
+        self.assertEqual(progress['processed'], 2)
+        self.assertEqual(progress['inserted'], 1)
+        self.assertEqual(self.actions_db.db_count(), 1)
+
+    def test_bulk_enqueue_twice(self):
+        body = '\n'.join([
+            '"123467890123456789014567"',
+            '"123467890123456789014568"',
+        ])
+        url = ('/internal/bulk-enqueue?action=tou'
+               '&params={"version":"2018-v1"}')
+        self.testapp.post(url, body, headers=HEADERS)
+        res = self.testapp.post(url, body, headers=HEADERS)
+        progress = json.loads(res.body.splitlines()[-1])
+        self.assertEqual(progress['inserted'], 0)
+        self.assertEqual(progress['duplicates'], 2)
+        self.assertEqual(self.actions_db.db_count(), 2)
+        action = self.actions_db.get_next_action('123467890123456789014567')
+        self.assertEqual(action.params, {'version': '2018-v1'})
+
+    def test_bulk_enqueue_params(self):
+        body = '"123467890123456789014567"'
+        url = ('/internal/bulk-enqueue?action=tou'
+               '&params={"version":"2018-v1","text":"new"}')
+        self.testapp.post(url, body, headers=HEADERS)
+        res = self.testapp.post(url, body, headers=HEADERS)
+        progress = json.loads(res.body.splitlines()[-1])
+        self.assertEqual(progress['duplicates'], 1)
+        action = self.actions_db.get_next_action('123467890123456789014567')
+        self.assertEqual(action.params, {'version': '2018-v1', 'text': 'new'})
+
+    def test_write_errors(self):
+        error = BulkWriteError({
+            'nUpserted': 1,
+            'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'E11000'}],
+        })
+        enqueuer = BulkEnqueuer(self.actions_db, 'tou')
+        with patch.object(self.actions_db._coll, 'bulk_write',
+                          side_effect=error):
+            progress = list(enqueuer.enqueue(['123467890123456789014567',
+                                              '123467890123456789014568']))
+        self.assertEqual(progress[-1], {
+            'processed': 2,
+            'inserted': 1,
+            'duplicates': 0,
+            'failed': 1,
+            'invalid': 0,
+        })
+
+    def test_bulk_enqueue_forbidden(self):
+        res = self.testapp.post('/internal/bulk-enqueue?action=tou', '',
+                                expect_errors=True)
+        self.assertEqual(res.status, '403 Forbidden')
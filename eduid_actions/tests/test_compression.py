@@ -0,0 +1,86 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import zlib
+from unittest import TestCase
+
+
+from eduid_actions.compression import choose_encoding, parse_accept_encoding
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+class NegotiationTests(TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_accept_encoding('gzip, br;q=0.5, x;q=bad'),
+                         {'gzip': 1.0, 'br': 0.5, 'x': 0.0})
+
+    def test_choose(self):
+        self.assertEqual(choose_encoding('gzip, deflate, br', ['br', 'gzip']),
+                         'br')
+        self.assertEqual(choose_encoding('gzip;q=1, br;q=0.5', ['br', 'gzip']),
+                         'gzip')
+        self.assertEqual(choose_encoding('gzip;q=0', ['gzip']), None)
+        self.assertEqual(choose_encoding('*', ['gzip']), 'gzip')
+        self.assertEqual(choose_encoding('', ['gzip']), None)
+
+
+class CompressionTests(FunctionalTestCase):
+
+    # No state is kept in the app
+    shared_app = True
+
+    app_settings = {
+        'compression.enabled': 'true',
+        'compression.min_size': '100',
+        'compression.brotli': 'false',
+    }
+
+    def _action_page(self, accept_encoding):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        return self.testapp.get(res.location,
+                                headers={'Accept-Encoding': accept_encoding})
+
+    def test_gzip(self):
+        res = self._action_page('gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        body = zlib.decompress(res.body, 16 + zlib.MAX_WBITS)
+        self.assertIn(b'Dummy action', body)
+
+    def test_identity(self):
+        res = self._action_page('identity')
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn(b'Dummy action', res.body)
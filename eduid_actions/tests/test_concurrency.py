@@ -0,0 +1,99 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+
+from bson import ObjectId
+from webtest import TestApp
+
+from eduid_actions.testing import FunctionalTestCase
+
+
+FLOWS = 200
+THREADS = 50
+
+
+class ConcurrentFlowsTests(FunctionalTestCase):
+    '''
+    Drive many concurrent flows through a single app instance,
+    each with its own user and cookies, and check that no flow
+    ever sees the session of another.
+    '''
+
+    def run_flow(self, userid):
+        testapp = TestApp(self.testapp.app)
+        # token verification is disabled in the setUp
+        # method of FunctionalTestCase
+        url = ('/?userid={0}&token=abc&nonce=sdf&ts=1401093117'.format(
+            userid))
+        res = testapp.get(url)
+        res = testapp.get(res.location)
+        expected = 'Dummy action for {0} by {0}'.format(userid)
+        if expected not in res.body:
+            raise AssertionError('Crossed sessions for {0}'.format(userid))
+        res = res.forms['dummy'].submit('submit')
+        res = testapp.get(res.location)
+        if not res.location.startswith(self.settings['idp_url']):
+            raise AssertionError('Flow for {0} did not finish'.format(userid))
+
+    def test_concurrent_flows(self):
+        userids = [str(ObjectId()) for _ in range(FLOWS)]
+        for userid in userids:
+            self.actions_db.add_action(data={
+                'user_oid': ObjectId(userid),
+                'action': 'dummy_echo',
+                'preference': 100,
+                'params': {},
+            })
+        pending = list(userids)
+        lock = threading.Lock()
+        failures = []
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    userid = pending.pop()
+                try:
+                    self.run_flow(userid)
+                except Exception as exc:
+                    failures.append(exc)
+
+        threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(self.actions_db.db_count(), 0)
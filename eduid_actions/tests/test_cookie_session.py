@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from unittest import TestCase
+
+from eduid_actions.session import CookieSession, CookieSessionFactory
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+class _FakeRequest(object):
+
+    def add_response_callback(self, callback):
+        pass
+
+
+class CookieSessionUnitTests(TestCase):
+
+    def test_pop_empty_flash(self):
+        session = CookieSession(_FakeRequest(), None, {'userid': 'abc'})
+        self.assertEqual(session.pop_flash(), [])
+        self.assertFalse(session._dirty)
+        session['_f_'] = ['message']
+        session._dirty = False
+        self.assertEqual(session.pop_flash(), ['message'])
+        self.assertTrue(session._dirty)
+        self.assertNotIn('_f_', session)
+
+
+class CookieSessionTests(FunctionalTestCase):
+
+    # No state is kept in the app
+    shared_app = True
+
+    app_settings = {'session.backend': 'cookie'}
+
+    def test_action_success(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        # token verification is disabled in the setUp
+        # method of FunctionalTestCase
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        self.assertEqual(res.status, '302 Found')
+        self.assertIn(self.settings['session.key'], self.testapp.cookies)
+        res = self.testapp.get(res.location)
+        form = res.forms['dummy']
+        res = form.submit('submit')
+        self.assertEqual(self.actions_db.db_count(), 0)
+        res = self.testapp.get(res.location)
+        self.assertEqual(res.status, '302 Found')
+        self.assertTrue(res.location.startswith(self.settings['idp_url']))
+
+    def test_tampered_cookie(self):
+        self.testapp.set_cookie(self.settings['session.key'], 'tampered')
+        res = self.testapp.get('/perform-action', expect_errors=True)
+        self.assertEqual(res.status, '403 Forbidden')
+
+    def test_expired_cookie(self):
+        factory = CookieSessionFactory(self.settings)
+        value = factory.dumps({'userid': 'abc'}, 1000)
+        self.assertEqual(factory.loads(value, now=1000 + 60),
+                         ({'userid': 'abc'}, 1000))
+        self.assertIsNone(factory.loads(value, now=1000 + 3601))
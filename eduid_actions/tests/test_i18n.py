@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from unittest import TestCase
+
+from jinja2 import Environment, DictLoader
+from mock import patch
+
+from eduid_actions.i18n import InlineTranslationsExtension
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+TEMPLATE = (u'<p>{{ _("Hello") }}</p>'
+            u'{% trans %}<b>World</b>{% endtrans %}'
+            u'{{ _("%(n)s left", n=1) }}')
+
+
+class InlineTranslationsTests(TestCase):
+
+    def setUp(self):
+        self.env = Environment(loader=DictLoader({'t': TEMPLATE}),
+                               extensions=['jinja2.ext.i18n'],
+                               autoescape=True)
+        self.env.install_gettext_callables(
+            lambda s: u'runtime ' + s,
+            lambda s, p, n: s,
+            newstyle=True)
+
+    def test_inlined(self):
+        variant = self.env.overlay(extensions=[InlineTranslationsExtension])
+        variant.inline_translate = lambda s: u'inlined ' + s
+        self.assertEqual(variant.get_template('t').render(),
+                         u'<p>inlined Hello</p>'
+                         u'inlined <b>World</b>'
+                         u'runtime 1 left')
+
+    def test_not_inlined(self):
+        self.assertEqual(self.env.get_template('t').render(),
+                         u'<p>runtime Hello</p>'
+                         u'runtime <b>World</b>'
+                         u'runtime 1 left')
+
+
+
+class _FakeLocalizer(object):
+
+    def __init__(self, lang):
+        self.lang = lang
+
+    def translate(self, msgid, domain=None):
+        return u'[{0}] {1}'.format(self.lang, msgid)
+
+
+class InlineTranslationsViewTests(FunctionalTestCase):
+
+    app_settings = {'jinja2.inline_translations': 'true'}
+
+    def setUp(self):
+        with patch('eduid_actions.i18n.make_localizer',
+                   lambda lang, dirs: _FakeLocalizer(lang)):
+            super(InlineTranslationsViewTests, self).setUp()
+
+    def _get_action_page(self, lang):
+        self.testapp.set_cookie('lang', lang)
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+               '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        return self.testapp.get(res.location)
+
+    def test_localized_variant(self):
+        res = self._get_action_page('sv')
+        self.assertEqual(res.status, '200 OK')
+        self.assertIn(u'[sv] eduID Login', res.text)
+        self.assertIn('dummy', res.forms)
+
+    def test_variant_per_locale(self):
+        res = self._get_action_page('en')
+        self.assertIn(u'[en] eduID Login', res.text)
+        self.assertNotIn(u'[sv]', res.text)
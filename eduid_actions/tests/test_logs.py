@@ -0,0 +1,149 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import logging
+from unittest import TestCase
+
+from mock import patch
+from six import StringIO
+
+from eduid_actions.logs import logger, log_event, set_sample_rates
+from eduid_actions.logs import hash_userid, BackgroundStreamHandler
+
+
+class _ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LogEventTests(TestCase):
+
+    def setUp(self):
+        self.handler = _ListHandler()
+        logger.addHandler(self.handler)
+        self.level = logger.level
+        logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        logger.removeHandler(self.handler)
+        logger.setLevel(self.level)
+        set_sample_rates({})
+
+    def test_event(self):
+        log_event('action_step', action='dummy', step=1, user='123')
+        record = self.handler.records[0]
+        self.assertEqual(record.event, 'action_step')
+        self.assertEqual(record.event_fields['step'], 1)
+        self.assertEqual(record.event_fields['user'], hash_userid('123'))
+        self.assertEqual(record.getMessage(),
+                         'event=action_step action=dummy step=1 '
+                         'user={0}'.format(hash_userid('123')))
+
+    def test_user_hashed_only_when_logged(self):
+        with patch('eduid_actions.logs.hash_userid') as hash_userid_mock:
+            log_event('action_step', level=logging.DEBUG, user='123')
+            self.assertFalse(hash_userid_mock.called)
+
+    def test_quoted(self):
+        log_event('action_step', reason=u'Action not performed',
+                  note=u'say "hi"', empty=u'', plain=u'ok')
+        self.assertEqual(self.handler.records[0].getMessage(),
+                         u'event=action_step empty="" note="say \\"hi\\"" '
+                         u'plain=ok reason="Action not performed"')
+
+    def test_disabled_level(self):
+        log_event('action_step', level=logging.DEBUG, action='dummy')
+        self.assertEqual(self.handler.records, [])
+
+    def test_sampling(self):
+        set_sample_rates({'logging.sample.flow_start': '0',
+                          'logging.sample.flow_finish': '1'})
+        for i in range(10):
+            log_event('flow_start')
+            log_event('flow_finish')
+        events = set(r.event for r in self.handler.records)
+        self.assertEqual(events, set(['flow_finish']))
+        self.assertEqual(len(self.handler.records), 10)
+
+
+class BackgroundStreamHandlerTests(TestCase):
+
+    def _wait(self, handler):
+        deadline = time.time() + 5
+        while not handler.queue.empty() and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+
+    def test_write(self):
+        stream = StringIO()
+        handler = BackgroundStreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        record = logging.LogRecord('eduid_actions', logging.INFO, __file__,
+                                   1, 'action %s', ('dummy',), None)
+        handler.handle(record)
+        self._wait(handler)
+        self.assertEqual(stream.getvalue(), 'INFO action dummy\n')
+
+    def test_close_drains_queue(self):
+        stream = StringIO()
+        handler = BackgroundStreamHandler(stream)
+        # Keep the writer busy until the records are queued
+        handler.handler.acquire()
+        try:
+            for i in range(3):
+                record = logging.LogRecord('eduid_actions', logging.INFO,
+                                           __file__, 1, 'msg', None, None)
+                handler.handle(record)
+        finally:
+            handler.handler.release()
+        handler.close()
+        self.assertEqual(stream.getvalue(), 'msg\n' * 3)
+        self.assertFalse(handler._thread.is_alive())
+
+    def test_drop_when_full(self):
+        handler = BackgroundStreamHandler(StringIO(), maxsize=1)
+        # Keep the writer busy so the queue fills up
+        handler.handler.acquire()
+        try:
+            for i in range(5):
+                record = logging.LogRecord('eduid_actions', logging.INFO,
+                                           __file__, 1, 'msg', None, None)
+                handler.handle(record)
+            self.assertGreater(handler.dropped, 0)
+        finally:
+            handler.handler.release()
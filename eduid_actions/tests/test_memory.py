@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from mock import patch
+
+from eduid_actions.memory import tracemalloc
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+HEADERS = {'X-Internal-Secret': 'internal-secret'}
+
+
+class MemoryDiagnosticsTests(FunctionalTestCase):
+
+    app_settings = {
+        'memory.enabled': 'true',
+        'memory.every': '1',
+        'internal_api_secret': 'internal-secret',
+    }
+
+    def setUp(self, *args, **kwargs):
+        if tracemalloc is None:
+            self.skipTest('tracemalloc is necessary for these tests')
+        super(MemoryDiagnosticsTests, self).setUp(*args, **kwargs)
+
+    def tearDown(self):
+        super(MemoryDiagnosticsTests, self).tearDown()
+        tracemalloc.stop()
+
+    def test_report(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        self.testapp.get(res.location)
+        res = self.testapp.get('/internal/memory?limit=3', headers=HEADERS)
+        report = res.json
+        self.assertIn('actions/none', report['routes'])
+        self.assertIn('perform-action/dummy', report['routes'])
+        stats = report['routes']['perform-action/dummy']
+        self.assertEqual(stats['samples'], 1)
+        self.assertTrue(len(stats['top']) <= 3)
+        self.assertTrue(report['traced']['current'] > 0)
+
+    def test_internal_only(self):
+        res = self.testapp.get('/internal/memory', expect_errors=True)
+        self.assertEqual(res.status_int, 403)
+
+    def test_signal_report(self):
+        memory_stats = self.testapp.app.registry.settings['memory_stats']
+        memory_stats.report_requested = True
+        with patch('eduid_actions.memory.logger') as logger:
+            self.testapp.get('/internal/memory', headers=HEADERS)
+        self.assertFalse(memory_stats.report_requested)
+        self.assertEqual(logger.warning.call_count, 1)
+
+    def test_threaded_not_sampled(self):
+        extra_environ = {'wsgi.multithread': True}
+        self.testapp.get('/internal/memory', headers=HEADERS,
+                         extra_environ=extra_environ)
+        res = self.testapp.get('/internal/memory', headers=HEADERS)
+        self.assertNotIn('memory-stats/none', res.json['routes'])
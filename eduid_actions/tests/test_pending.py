@@ -0,0 +1,100 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+HEADERS = {'X-Internal-Secret': 'internal-secret'}
+
+
+class PendingActionsTests(FunctionalTestCase):
+
+    app_settings = {
+        'internal_api_secret': 'internal-secret',
+        'pending_actions_index.enabled': 'true',
+    }
+
+    def setUp(self, *args, **kwargs):
+        super(PendingActionsTests, self).setUp(*args, **kwargs)
+        self.index = self.testapp.app.registry.settings['pending_actions_index']
+
+    def test_pending(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        self.index.refresh()
+        url = '/internal/pending-actions?userid=123467890123456789014567'
+        res = self.testapp.get(url, headers=HEADERS)
+        self.assertEqual(res.json, {'pending': True})
+
+    def test_not_pending(self):
+        self.index.refresh()
+        url = '/internal/pending-actions?userid=123467890123456789014567'
+        res = self.testapp.get(url, headers=HEADERS)
+        self.assertEqual(res.json, {'pending': False})
+
+    def test_removed_action(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        self.index.refresh()
+        self.actions_db.remove_action_by_id(DUMMY_ACTION['_id'])
+        url = '/internal/pending-actions?userid=123467890123456789014567'
+        res = self.testapp.get(url, headers=HEADERS)
+        self.assertEqual(res.json, {'pending': False})
+        self.assertNotIn(DUMMY_ACTION['user_oid'], self.index._users)
+
+    def test_old_id_found_on_full_reload(self):
+        self.index.refresh()
+        # The _id of the dummy action is far older than the watermark
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        self.index.refresh()
+        self.assertNotIn(DUMMY_ACTION['user_oid'], self.index._users)
+        self.index._loaded -= self.index.full_reload
+        self.index.refresh()
+        self.assertIn(DUMMY_ACTION['user_oid'], self.index._users)
+
+    def test_full_reload_drops_removed(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        self.index.refresh()
+        self.actions_db.remove_action_by_id(DUMMY_ACTION['_id'])
+        self.index._loaded -= self.index.full_reload
+        self.index.refresh()
+        self.assertNotIn(DUMMY_ACTION['user_oid'], self.index._users)
+
+    def test_bad_secret(self):
+        url = '/internal/pending-actions?userid=123467890123456789014567'
+        res = self.testapp.get(url, headers={'X-Internal-Secret': 'wrong'},
+                               expect_errors=True)
+        self.assertEqual(res.status, '403 Forbidden')
+
+    def test_invalid_userid(self):
+        url = '/internal/pending-actions?userid=not-an-oid'
+        res = self.testapp.get(url, headers=HEADERS, expect_errors=True)
+        self.assertEqual(res.status, '400 Bad Request')
@@ -0,0 +1,90 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import threading
+from unittest import TestCase
+
+from eduid_actions.action_abc import Prefetched, PrefetchPool
+
+
+class PrefetchTests(TestCase):
+
+    def setUp(self):
+        self.pool = PrefetchPool(max_workers=1, max_pending=0)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def block(self):
+        self.release.wait(5)
+        return u'blocked'
+
+    def test_prefetched(self):
+        loaders = {'a': lambda: u'loaded'}
+        futures = dict((name, self.pool.submit(loader))
+                       for name, loader in loaders.items())
+        prefetched = Prefetched(loaders, futures, timeout=5)
+        self.assertEqual(prefetched['a'], u'loaded')
+        self.assertEqual(prefetched.get('b', u'default'), u'default')
+
+    def test_saturated(self):
+        self.assertIsNotNone(self.pool.submit(self.block))
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return u'inline'
+
+        future = self.pool.submit(loader)
+        self.assertIsNone(future)
+        prefetched = Prefetched({'a': loader}, {'a': future}, timeout=5)
+        self.assertEqual(prefetched['a'], u'inline')
+        self.assertEqual(prefetched['a'], u'inline')
+        self.assertEqual(calls, [1])
+
+    def test_timeout(self):
+        future = self.pool.submit(self.block)
+        prefetched = Prefetched({'a': lambda: u'inline'}, {'a': future},
+                                timeout=0.01)
+        self.assertEqual(prefetched['a'], u'inline')
+
+    def test_slot_released(self):
+        self.pool.submit(lambda: None).result(5)
+        # The slot is released by a callback, right after the result is set
+        for i in range(100):
+            future = self.pool.submit(lambda: None)
+            if future is not None:
+                break
+            time.sleep(0.01)
+        self.assertIsNotNone(future)
@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import pstats
+import shutil
+import tempfile
+
+from eduid_actions.profiling import sign_profile_request
+from eduid_actions.testing import FunctionalTestCase
+
+
+class ProfilingTests(FunctionalTestCase):
+
+    def setUp(self, *args, **kwargs):
+        self.directory = tempfile.mkdtemp()
+        self.settings = {
+            'profiling.enabled': 'true',
+            'profiling.directory': self.directory,
+            'profiling.max_files': 2,
+            'profiling.secret': 'profiling-secret',
+        }
+        super(ProfilingTests, self).setUp(*args, **kwargs)
+
+    def tearDown(self):
+        super(ProfilingTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_not_profiled(self):
+        self.testapp.get('/perform-action', expect_errors=True)
+        self.assertEqual(self.profiles(), [])
+
+    def test_signed_header(self):
+        header = sign_profile_request('profiling-secret')
+        for _ in range(3):
+            self.testapp.get('/perform-action', expect_errors=True,
+                             headers={'X-Actions-Profile': header})
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(profiles[0].endswith('-perform_action-none.prof'))
+        pstats.Stats(os.path.join(self.directory, profiles[0]))
+
+    def test_bad_signature(self):
+        header = sign_profile_request('wrong-secret')
+        self.testapp.get('/perform-action', expect_errors=True,
+                         headers={'X-Actions-Profile': header})
+        self.assertEqual(self.profiles(), [])
@@ -0,0 +1,98 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from copy import deepcopy
+
+from bson import ObjectId
+from mock import patch
+
+from eduid_actions.purge import ActionsPurger, PurgeJob
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+class PurgeTests(FunctionalTestCase):
+
+    # No state is kept in the app
+    shared_app = True
+
+    def setUp(self, *args, **kwargs):
+        super(PurgeTests, self).setUp(*args, **kwargs)
+        # kept, no session
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        # stale, with a session and an old id
+        stale = deepcopy(DUMMY_ACTION)
+        stale['_id'] = ObjectId('234567890123456789012302')
+        stale['session'] = 'abcd'
+        self.actions_db.add_action(data=stale)
+        # kept, with a session but recent
+        recent = deepcopy(DUMMY_ACTION)
+        recent['_id'] = ObjectId()
+        recent['session'] = 'abcd'
+        self.actions_db.add_action(data=recent)
+        # orphaned
+        orphaned = deepcopy(DUMMY_ACTION)
+        orphaned['_id'] = ObjectId('234567890123456789012303')
+        orphaned['action'] = 'uninstalled'
+        self.actions_db.add_action(data=orphaned)
+        self.purger = ActionsPurger(self.actions_db, ['uninstalled'],
+                                    session_max_age=3600,
+                                    batch_size=1, pause=0)
+
+    def test_dry_run(self):
+        report = self.purger.report(['dummy'])
+        self.assertEqual(report, {'stale': 1,
+                                  'orphaned': {'uninstalled': 1},
+                                  'uninstalled': {'uninstalled': 1}})
+        self.assertEqual(self.actions_db.db_count(), 4)
+
+    def test_purge(self):
+        purged = self.purger.purge()
+        self.assertEqual(purged, {'stale': 1, 'orphaned': 1})
+        self.assertEqual(self.actions_db.db_count(), 2)
+
+    def test_no_orphaned_types(self):
+        purger = ActionsPurger(self.actions_db, session_max_age=3600)
+        purged = purger.purge()
+        self.assertEqual(purged, {'stale': 1, 'orphaned': 0})
+        self.assertEqual(self.actions_db.db_count(), 3)
+
+    def test_job_started_per_process(self):
+        job = PurgeJob(self.actions_db, 3600)
+        with patch.object(PurgeJob, '_run'):
+            with patch('eduid_actions.threads.threading.Thread') as thread:
+                job.ensure_started()
+                job.ensure_started()
+                self.assertEqual(thread.call_count, 1)
+                # as after a fork
+                job._thread.pid = -1
+                job.ensure_started()
+                self.assertEqual(thread.call_count, 2)
@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from unittest import TestCase
+
+
+from eduid_actions.ratelimit import TokenBuckets, RedisTokenBuckets
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+
+class TokenBucketsTests(TestCase):
+
+    def test_burst_then_refill(self):
+        buckets = TokenBuckets(rate=1, burst=2)
+        self.assertTrue(buckets.consume('a', now=100))
+        self.assertTrue(buckets.consume('a', now=100))
+        self.assertFalse(buckets.consume('a', now=100))
+        self.assertTrue(buckets.consume('b', now=100))
+        self.assertTrue(buckets.consume('a', now=101))
+        self.assertFalse(buckets.consume('a', now=101))
+
+    def test_max_keys(self):
+        buckets = TokenBuckets(rate=1, burst=1, max_keys=2)
+        for key in ('a', 'b', 'c'):
+            buckets.consume(key, now=100)
+        self.assertEqual(list(buckets._buckets.keys()), ['b', 'c'])
+
+
+class _FakePipeline(object):
+
+    def __init__(self, store):
+        self.store = store
+        self.results = []
+
+    def incrby(self, key, amount):
+        self.store[key] = self.store.get(key, 0) + amount
+        self.results.append(self.store[key])
+
+    def expire(self, key, seconds):
+        self.results.append(True)
+
+    def execute(self):
+        return self.results
+
+
+class _FakeRedis(object):
+
+    def __init__(self):
+        self.store = {}
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self.store)
+
+
+class RedisTokenBucketsTests(TestCase):
+
+    def test_blocked_after_global_limit(self):
+        client = _FakeRedis()
+        buckets = RedisTokenBuckets(client, rate=0, burst=10, window=10,
+                                    sync_interval=0)
+        # another worker has already used up the window
+        client.store['eduid_actions:ratelimit:a:10'] = 10
+        self.assertTrue(buckets.consume('a', now=100))
+        self.assertFalse(buckets.consume('a', now=101))
+        self.assertTrue(buckets.consume('b', now=101))
+
+    def test_max_keys(self):
+        buckets = RedisTokenBuckets(_FakeRedis(), rate=1, burst=1,
+                                    sync_interval=3600, max_keys=2)
+        for key in ('a', 'b', 'c'):
+            buckets.consume(key, now=100)
+        self.assertEqual(list(buckets._buckets.keys()), ['b', 'c'])
+
+
+class RateLimitTweenTests(FunctionalTestCase):
+
+    app_settings = {
+        'ratelimit.enabled': 'true',
+        'ratelimit.userid_rate': '0',
+        'ratelimit.userid_burst': '1',
+    }
+
+    def test_limited_before_session(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        self.assertEqual(res.status, '302 Found')
+        self.assertIn(self.settings['session.key'], self.testapp.cookies)
+        self.testapp.reset()
+        res = self.testapp.get(url, expect_errors=True)
+        self.assertEqual(res.status_int, 429)
+        self.assertNotIn('Set-Cookie', res.headers)
+        self.assertNotIn(self.settings['session.key'], self.testapp.cookies)
@@ -0,0 +1,85 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from copy import deepcopy
+
+from bson import ObjectId
+
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+class RenderNextActionTests(FunctionalTestCase):
+
+    # No state is kept in the app
+    shared_app = True
+
+    app_settings = {'render_next_action': 'true'}
+
+    def setUp(self, *args, **kwargs):
+        super(RenderNextActionTests, self).setUp(*args, **kwargs)
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        action2 = deepcopy(DUMMY_ACTION)
+        action2['_id'] = ObjectId('234567890123456789012302')
+        action2['action'] = 'dummy2'
+        action2['preference'] = 200
+        self.actions_db.add_action(data=action2)
+
+    def start(self):
+        # token verification is disabled in the setUp
+        # method of FunctionalTestCase
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        return self.testapp.get(res.location)
+
+    def test_two_actions(self):
+        res = self.start()
+        form = res.forms['dummy']
+        self.assertIn('_step_token', form.fields)
+        res = form.submit('submit')
+        self.assertEqual(res.status, '200 OK')
+        self.assertEqual(self.actions_db.db_count(), 1)
+        form = res.forms['dummy']
+        res = form.submit('submit')
+        self.assertEqual(self.actions_db.db_count(), 0)
+        self.assertEqual(res.status, '302 Found')
+        self.assertTrue(res.location.startswith(self.settings['idp_url']))
+
+    def test_resubmit(self):
+        res = self.start()
+        old_form = res.forms['dummy']
+        res = old_form.submit('submit')
+        self.assertEqual(self.actions_db.db_count(), 1)
+        res = old_form.submit('submit')
+        self.assertEqual(res.status, '302 Found')
+        self.assertEqual(res.location, 'http://localhost/perform-action')
+        self.assertEqual(self.actions_db.db_count(), 1)
@@ -0,0 +1,136 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+from unittest import TestCase
+from mock import patch
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.sentinel import SentinelManagedConnection
+
+from eduid_actions.sentinel import SentinelMaster, CachedSentinelConnectionPool
+from eduid_actions.sentinel import CachedSentinelConnection
+
+
+class _FakeSentinel(object):
+
+    def __init__(self, address):
+        self.address = address
+        self.lookups = 0
+
+    def discover_master(self, service_name):
+        self.lookups += 1
+        return self.address
+
+
+class SentinelMasterTests(TestCase):
+
+    def setUp(self):
+        self.sentinel = _FakeSentinel(('10.0.0.1', 6379))
+        self.master = SentinelMaster(self.sentinel, 'redis-cluster',
+                                     refresh_interval=10,
+                                     retry_interval=0.25, max_failover=60)
+
+    def test_cached(self):
+        for i in range(3):
+            self.assertEqual(self.master.address(), ('10.0.0.1', 6379))
+        self.assertEqual(self.sentinel.lookups, 1)
+
+    def test_failover(self):
+        self.master.discover()
+        self.master.connection_failed()
+        self.assertEqual(self.master._interval(), 0.25)
+        self.sentinel.address = ('10.0.0.2', 6379)
+        self.master.discover()
+        self.assertEqual(self.master.address(), ('10.0.0.2', 6379))
+        stats = self.master.stats()
+        self.assertEqual(stats['failovers'], 1)
+        self.assertEqual(stats['connection_errors'], 1)
+        self.assertFalse(stats['failing'])
+        self.assertTrue(stats['last_failover_seconds'] >= 0)
+        self.assertEqual(self.master._interval(), 10)
+
+    def test_failing_is_bounded(self):
+        self.master.discover()
+        self.master.connection_failed()
+        self.master._failing_since = time.time() - 61
+        self.assertEqual(self.master._interval(), 10)
+        self.assertFalse(self.master.stats()['failing'])
+
+    def test_connection_succeeded(self):
+        self.master.discover()
+        self.master.connection_failed()
+        self.master.connection_succeeded()
+        self.assertEqual(self.master._interval(), 10)
+
+    def test_poller_started_per_process(self):
+        with patch('eduid_actions.threads.threading.Thread') as thread:
+            self.master.discover()
+            self.assertEqual(thread.call_count, 0)
+            self.master.address()
+            self.master.address()
+            self.assertEqual(thread.call_count, 1)
+            # as after a fork
+            self.master._poller.pid = -1
+            self.master.address()
+            self.assertEqual(thread.call_count, 2)
+
+
+class CachedSentinelConnectionPoolTests(TestCase):
+
+    def test_master_moved(self):
+        sentinel = _FakeSentinel(('10.0.0.1', 6379))
+        master = SentinelMaster(sentinel, 'redis-cluster')
+        pool = CachedSentinelConnectionPool(master)
+        disconnects = []
+        pool.disconnect = lambda *args, **kwargs: disconnects.append(1)
+        self.assertEqual(pool.get_master_address(), ('10.0.0.1', 6379))
+        self.assertEqual(pool.get_master_address(), ('10.0.0.1', 6379))
+        self.assertEqual(disconnects, [])
+        sentinel.address = ('10.0.0.2', 6379)
+        master.discover()
+        self.assertEqual(pool.get_master_address(), ('10.0.0.2', 6379))
+        self.assertEqual(disconnects, [1])
+        self.assertEqual(sentinel.lookups, 2)
+
+    def test_read_errors(self):
+        master = SentinelMaster(_FakeSentinel(('10.0.0.1', 6379)),
+                                'redis-cluster')
+        pool = CachedSentinelConnectionPool(master)
+        connection = CachedSentinelConnection(connection_pool=pool)
+        with patch.object(SentinelManagedConnection, 'read_response',
+                          side_effect=TimeoutError()):
+            self.assertRaises(TimeoutError, connection.read_response)
+        self.assertEqual(master.stats()['connection_errors'], 0)
+        with patch.object(SentinelManagedConnection, 'read_response',
+                          side_effect=ConnectionError()):
+            self.assertRaises(ConnectionError, connection.read_response)
+        self.assertEqual(master.stats()['connection_errors'], 1)
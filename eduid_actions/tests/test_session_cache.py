@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from unittest import TestCase
+
+from pyramid.interfaces import ISessionFactory
+from pyramid.request import Request
+
+from eduid_actions.session import SessionCache
+from eduid_actions.testing import FunctionalTestCase
+
+
+class _FakePipeline(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = []
+
+    def incr(self, key):
+        self.results.append(self.conn.incr(key))
+
+    def expire(self, key, seconds):
+        self.results.append(True)
+
+    def execute(self):
+        return self.results
+
+
+class _FakeRedis(object):
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def incr(self, key):
+        value = int(self.store.get(key, 0)) + 1
+        self.store[key] = str(value).encode('ascii')
+        return value
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakeSession(dict):
+
+    def __init__(self, token):
+        super(_FakeSession, self).__init__()
+        self.token = token
+
+
+class SessionCacheTests(TestCase):
+
+    def setUp(self):
+        self.conn = _FakeRedis()
+        self.cache = SessionCache(self.conn, 2, 3600)
+        self.fetched = []
+
+    def fetch(self, token):
+        def _fetch():
+            self.fetched.append(token)
+            return _FakeSession(token)
+        return _fetch
+
+    def test_hit(self):
+        first = self.cache.get('a', self.fetch('a'))
+        second = self.cache.get('a', self.fetch('a'))
+        self.assertEqual(first, second)
+        self.assertEqual(self.fetched, ['a'])
+
+    def test_copies(self):
+        first = self.cache.get('a', self.fetch('a'))
+        first['userid'] = 'uncommitted'
+        second = self.cache.get('a', self.fetch('a'))
+        second['step'] = 2
+        third = self.cache.get('a', self.fetch('a'))
+        self.assertIsNot(first, third)
+        self.assertIsNot(second, third)
+        self.assertEqual(third, {})
+        self.assertEqual(third.token, 'a')
+
+    def test_own_write_drops_entry(self):
+        session = self.cache.get('a', self.fetch('a'))
+        self.cache.writing('a')
+        self.cache.written('a')
+        self.assertNotIn('a', self.cache._entries)
+        self.cache.get('a', self.fetch('a'))
+        self.assertEqual(self.fetched, ['a', 'a'])
+        self.assertEqual(self.conn.store[self.cache.prefix + 'a'], b'2')
+        self.assertIsNotNone(session)
+
+    def test_write_by_other_worker(self):
+        self.cache.get('a', self.fetch('a'))
+        other = SessionCache(self.conn, 2, 3600)
+        other.writing('a')
+        other.written('a')
+        self.cache.get('a', self.fetch('a'))
+        self.assertEqual(self.fetched, ['a', 'a'])
+
+    def test_bounded(self):
+        for token in ('a', 'b', 'c'):
+            self.cache.get(token, self.fetch(token))
+        self.assertEqual(list(self.cache._entries.keys()), ['b', 'c'])
+
+
+class SessionFactoryCacheTests(FunctionalTestCase):
+
+    app_settings = {
+        'session.backend': 'redis',
+        'session.local_cache_size': '10',
+    }
+
+    def setUp(self):
+        super(SessionFactoryCacheTests, self).setUp()
+        self.registry = self.testapp.app.registry
+        self.factory = self.registry.getUtility(ISessionFactory)
+
+    def request(self, token=None):
+        headers = {}
+        if token is not None:
+            headers['Cookie'] = '{0}={1}'.format(
+                self.settings['session.key'], token)
+        request = Request.blank('/', headers=headers)
+        request.registry = self.registry
+        return request
+
+    def test_sessions_not_shared(self):
+        token = self.factory(self.request())._session.token
+        first = self.factory(self.request(token))
+        second = self.factory(self.request(token))
+        self.assertIsNot(first._session, second._session)
+
+    def test_uncommitted_changes_not_cached(self):
+        token = self.factory(self.request())._session.token
+        self.factory(self.request(token))
+        failed = self.factory(self.request(token))
+        # changed, but never persisted
+        failed._session['userid'] = 'uncommitted'
+        session = self.factory(self.request(token))
+        self.assertNotIn('userid', session._session)
+
+    def test_committed_changes(self):
+        token = self.factory(self.request())._session.token
+        self.factory(self.request(token))
+        session = self.factory(self.request(token))
+        session._session['userid'] = 'committed'
+        session.persist()
+        session = self.factory(self.request(token))
+        self.assertEqual(session._session['userid'], 'committed')
@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+HEADERS = {'X-Internal-Secret': 'internal-secret'}
+
+
+class QueueStatsTests(FunctionalTestCase):
+
+    app_settings = {'internal_api_secret': 'internal-secret'}
+
+    def test_stats(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        recent = deepcopy(DUMMY_ACTION)
+        recent['_id'] = ObjectId()
+        self.actions_db.add_action(data=recent)
+        res = self.testapp.get('/internal/stats', headers=HEADERS)
+        self.assertEqual(res.json['totals'], {'dummy': 2})
+        self.assertEqual(res.json['breakdown'], [
+            {'action': 'dummy', 'preference': 100, 'age': '1h', 'count': 1},
+            {'action': 'dummy', 'preference': 100, 'age': 'older',
+             'count': 1},
+        ])
+
+    def test_stats_age_order(self):
+        now = datetime.utcnow()
+        for age in (timedelta(days=3), timedelta(minutes=10),
+                    timedelta(hours=2)):
+            action = deepcopy(DUMMY_ACTION)
+            action['_id'] = ObjectId.from_datetime(now - age)
+            self.actions_db.add_action(data=action)
+        res = self.testapp.get('/internal/stats', headers=HEADERS)
+        self.assertEqual([item['age'] for item in res.json['breakdown']],
+                         ['1h', '1d', '7d'])
+
+    def test_stats_cached(self):
+        res1 = self.testapp.get('/internal/stats', headers=HEADERS)
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        res2 = self.testapp.get('/internal/stats', headers=HEADERS)
+        self.assertEqual(res1.json, res2.json)
@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+from copy import deepcopy
+from unittest import TestCase
+
+from mock import patch
+from pyramid.response import Response
+
+from eduid_actions.submits import SubmitGuard
+from eduid_actions.testing import FunctionalTestCase, DUMMY_ACTION
+
+
+
+class SubmitGuardTests(TestCase):
+
+    def test_concurrent_duplicates(self):
+        guard = SubmitGuard()
+        calls = []
+        started = threading.Event()
+        finish = threading.Event()
+
+        def perform():
+            calls.append(1)
+            started.set()
+            finish.wait(5)
+            return Response(body=b'done', status='200 OK')
+
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(guard.run('key', perform)))
+        first.start()
+        started.wait(5)
+        # Duplicates are answered while the first is still running
+        self.assertIsNone(guard.run('key', perform))
+        self.assertIsNone(guard.run('key', perform))
+        finish.set()
+        first.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r.body for r in results], [b'done'])
+
+    def test_duplicate_after_finish(self):
+        guard = SubmitGuard()
+        guard.run('key', lambda: Response(body=b'first'))
+        self.assertIsNone(guard.run('key', lambda: Response(body=b'second')))
+
+    def test_failure_is_not_remembered(self):
+        guard = SubmitGuard()
+
+        def fail():
+            raise RuntimeError('backend down')
+
+        self.assertRaises(RuntimeError, guard.run, 'key', fail)
+        response = guard.run('key', lambda: Response(body=b'done'))
+        self.assertEqual(response.body, b'done')
+
+    def test_expiry(self):
+        guard = SubmitGuard(ttl=0)
+        guard.run('key', lambda: Response(body=b'first'))
+        response = guard.run('key', lambda: Response(body=b'second'))
+        self.assertEqual(response.body, b'second')
+
+    def test_key(self):
+        guard = SubmitGuard()
+        key1 = guard.key('user', 'form', {'a': '1', 'b': '2'})
+        key2 = guard.key('user', 'form', {'b': '2', 'a': '1'})
+        key3 = guard.key('user', 'form', {'a': '1', 'b': '3'})
+        key4 = guard.key('user', 'other', {'a': '1', 'b': '2'})
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+        self.assertNotEqual(key1, key4)
+
+
+class DuplicateSubmitTests(FunctionalTestCase):
+
+    app_settings = {'submit_guard.enabled': 'true'}
+
+    def test_resubmitted_final_step(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        res = self.testapp.get(res.location)
+        form = res.forms['dummy']
+        self.assertIn('_step_token', form.fields)
+        with patch('eduid_actions.testing.DummyActionPlugin.perform_action',
+                   return_value=None) as perform_action:
+            first = form.submit('submit')
+            second = form.submit('submit')
+        self.assertEqual(perform_action.call_count, 1)
+        self.assertEqual(first.status, '302 Found')
+        self.assertEqual(second.status, '302 Found')
+        self.assertEqual(second.location, 'http://localhost/perform-action')
+        self.assertEqual(self.actions_db.db_count(), 0)
+
+    def test_resubmitted_first_step(self):
+        action = deepcopy(DUMMY_ACTION)
+        action['action'] = 'dummy_2steps'
+        self.actions_db.add_action(data=action)
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        res = self.testapp.get(res.location)
+        form = res.forms['dummy']
+        first = form.submit('submit')
+        self.assertEqual(first.status, '200 OK')
+        # The session has moved on to the second step, and the
+        # duplicate is not answered with a replay of the first response
+        second = form.submit('submit')
+        self.assertEqual(second.status, '302 Found')
+        self.assertEqual(second.location, 'http://localhost/perform-action')
+        res = self.testapp.get(second.location)
+        self.assertEqual(res.status, '200 OK')
@@ -0,0 +1,65 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from unittest import TestCase
+
+from mock import patch
+
+from eduid_actions.threads import ForkSafeThread
+
+
+class ForkSafeThreadTests(TestCase):
+
+    def setUp(self):
+        self.forks = []
+        self.thread = ForkSafeThread(lambda: None, 'test',
+                                     on_fork=lambda: self.forks.append(1))
+
+    def test_started_per_process(self):
+        with patch('eduid_actions.threads.threading.Thread') as thread:
+            self.assertTrue(self.thread.ensure_started())
+            self.assertFalse(self.thread.ensure_started())
+            self.assertEqual(thread.call_count, 1)
+            self.assertEqual(self.forks, [])
+            # as after a fork
+            self.thread.pid = -1
+            self.assertTrue(self.thread.ensure_started())
+            self.assertEqual(thread.call_count, 2)
+            self.assertEqual(self.forks, [1])
+
+    def test_restarted_when_dead(self):
+        with patch('eduid_actions.threads.threading.Thread') as thread:
+            self.thread.ensure_started()
+            thread.return_value.is_alive.return_value = False
+            self.assertFalse(self.thread.ensure_started())
+            self.assertEqual(thread.call_count, 2)
+            self.assertEqual(self.forks, [])
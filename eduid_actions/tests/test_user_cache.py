@@ -0,0 +1,145 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from unittest import TestCase
+
+from bson import ObjectId
+
+from eduid_actions.user import UserCache, invalidate_on_update_attributes
+
+
+USER_OID = ObjectId('123467890123456789014567')
+
+
+class _FakeCollection(object):
+
+    def __init__(self):
+        self.docs = {USER_OID: {'_id': USER_OID, 'modified_ts': 1,
+                                'givenName': 'John'}}
+        self.full_loads = 0
+
+    def find_one(self, spec, projection=None):
+        doc = self.docs.get(spec['_id'])
+        if doc is None:
+            return None
+        if projection is None:
+            self.full_loads += 1
+            return dict(doc)
+        return dict((k, v) for k, v in doc.items() if k in projection)
+
+
+class _FakeUser(object):
+
+    built = []
+
+    def __init__(self, data):
+        self.built.append(data)
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+class _FakeUserDB(object):
+
+    def __init__(self):
+        self._coll = _FakeCollection()
+
+
+class UserCacheTests(TestCase):
+
+    def setUp(self):
+        self.amdb = _FakeUserDB()
+        self.cache = UserCache(self.amdb, max_entries=2, ttl=30,
+                               user_class=_FakeUser)
+        _FakeUser.built = []
+
+    def test_hit(self):
+        user = self.cache.get(USER_OID)
+        cached = self.cache.get(USER_OID)
+        self.assertIsNot(cached, user)
+        self.assertEqual(cached.to_dict(), user.to_dict())
+        self.assertEqual(self.amdb._coll.full_loads, 1)
+
+    def test_parsed_once_per_get(self):
+        self.cache.get(USER_OID)
+        self.assertEqual(len(_FakeUser.built), 1)
+        self.cache.get(USER_OID)
+        self.assertEqual(len(_FakeUser.built), 2)
+        # the hit is built from the cached document, not from the db
+        self.assertEqual(self.amdb._coll.full_loads, 1)
+
+    def test_copies(self):
+        user = self.cache.get(USER_OID)
+        user.data['givenName'] = 'Changed'
+        cached = self.cache.get(USER_OID)
+        cached.data['givenName'] = 'Changed again'
+        cached = self.cache.get(USER_OID)
+        self.assertEqual(cached.data['givenName'], 'John')
+
+    def test_missing(self):
+        self.assertIsNone(self.cache.get(ObjectId()))
+        self.assertEqual(_FakeUser.built, [])
+
+    def test_modified(self):
+        user = self.cache.get(USER_OID)
+        self.amdb._coll.docs[USER_OID]['modified_ts'] = 2
+        self.assertIsNot(self.cache.get(USER_OID), user)
+        self.assertEqual(self.amdb._coll.full_loads, 2)
+
+    def test_expired(self):
+        self.cache.ttl = 0
+        self.cache.get(USER_OID)
+        self.cache.get(USER_OID)
+        self.assertEqual(self.amdb._coll.full_loads, 2)
+
+    def test_invalidate(self):
+        self.cache.get(USER_OID)
+        self.cache.invalidate(USER_OID)
+        self.cache.get(USER_OID)
+        self.assertEqual(self.amdb._coll.full_loads, 2)
+
+    def test_signal_connected_once(self):
+        from celery.signals import before_task_publish
+        other = UserCache(self.amdb, user_class=_FakeUser)
+        invalidate_on_update_attributes(self.cache)
+        invalidate_on_update_attributes(other)
+        receivers = [r for r in before_task_publish.receivers
+                     if r[0][0] == 'eduid_actions.user_cache']
+        self.assertEqual(len(receivers), 1)
+        self.cache.get(USER_OID)
+        other.get(USER_OID)
+        before_task_publish.send(sender='eduid_am.tasks.update_attributes',
+                                 body={'args': ['eduid_actions',
+                                                str(USER_OID)]})
+        self.assertNotIn(USER_OID, self.cache._entries)
+        self.assertNotIn(USER_OID, other._entries)
@@ -31,8 +31,11 @@
 #
 
 from copy import deepcopy
+from unittest import TestCase
+from mock import patch
 from bson import ObjectId
-from eduid_actions.testing import FunctionalTestCase
+from eduid_actions import PluginsRegistry
+from eduid_actions.testing import FunctionalTestCase, DummyActionPlugin2
 
 
 DUMMY_ACTION = {
@@ -126,6 +129,7 @@ class ActionTests(FunctionalTestCase):
         self.assertEqual(self.actions_db.db_count(), 0)
 
     def test_method_not_allowed(self):
+        self.actions_db.add_action(data=DUMMY_ACTION)
         url = ('/?userid=123467890123456789014567'
                 '&token=abc&nonce=sdf&ts=1401093117')
         res = self.testapp.put(url, expect_errors=True)
@@ -214,10 +218,8 @@ class ActionTests(FunctionalTestCase):
         self.assertEqual(self.actions_db.db_count(), 0)
         res = self.testapp.get(url)
         self.assertEqual(res.status, '302 Found')
-        self.assertEqual(res.location, 'http://localhost/perform-action')
-        res = self.testapp.get(res.location)
-        self.assertEqual(res.status, '302 Found')
         self.assertTrue(res.location.startswith(self.settings['idp_url']))
+        self.assertNotIn(self.settings['session.key'], self.testapp.cookies)
         self.assertEqual(self.actions_db.db_count(), 0)
 
     def test_action_success_with_session(self):
@@ -252,9 +254,6 @@ class ActionTests(FunctionalTestCase):
         self.assertEqual(self.actions_db.db_count(), 1)
         res = self.testapp.get(url)
         self.assertEqual(res.status, '302 Found')
-        self.assertEqual(res.location, 'http://localhost/perform-action')
-        res = self.testapp.get(res.location)
-        self.assertEqual(res.status, '302 Found')
         self.assertTrue(res.location.startswith(self.settings['idp_url']))
         self.assertEqual(self.actions_db.db_count(), 1)
 
@@ -269,9 +268,6 @@ class ActionTests(FunctionalTestCase):
         self.assertEqual(self.actions_db.db_count(), 1)
         res = self.testapp.get(url)
         self.assertEqual(res.status, '302 Found')
-        self.assertEqual(res.location, 'http://localhost/perform-action')
-        res = self.testapp.get(res.location)
-        self.assertEqual(res.status, '302 Found')
         self.assertTrue(res.location.startswith(self.settings['idp_url']))
         self.assertEqual(self.actions_db.db_count(), 1)
 
@@ -351,3 +347,114 @@ class ActionTests(FunctionalTestCase):
         form = res.forms['dummy']
         res = form.submit('submit')
         self.assertEqual(self.actions_db.db_count(), 0)
+
+    def test_not_found_cached(self):
+        error_pages = self.testapp.app.registry.settings['error_pages']
+        res1 = self.testapp.get('/does-not-exist', expect_errors=True)
+        self.assertEqual(res1.status, '404 Not Found')
+        self.assertEqual(len(error_pages._pages), 1)
+        res2 = self.testapp.get('/does-not-exist-either', expect_errors=True)
+        self.assertEqual(res2.status, '404 Not Found')
+        self.assertEqual(res1.body, res2.body)
+        self.assertEqual(len(error_pages._pages), 1)
+        self.assertNotIn(self.settings['session.key'], self.testapp.cookies)
+
+    def test_error_pages_ignore_host(self):
+        error_pages = self.testapp.app.registry.settings['error_pages']
+        error_pages._pages.clear()
+        for host in ('a.example.com', 'b.example.com', 'c.example.com'):
+            res = self.testapp.get('/does-not-exist', expect_errors=True,
+                                   headers={'Host': host})
+            self.assertEqual(res.status, '404 Not Found')
+            self.assertNotIn(host, res.body)
+        self.assertEqual(len(error_pages._pages), 1)
+
+    def test_action_single_request_steps(self):
+        action = deepcopy(DUMMY_ACTION)
+        action['action'] = 'dummy_single'
+        self.actions_db.add_action(data=action)
+        # token verification is disabled in the setUp
+        # method of FunctionalTestCase
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        res = self.testapp.get(res.location)
+        self.assertIn('step 1 first', res.body)
+        form = res.forms['dummy']
+        res = form.submit('submit')
+        self.assertEqual(res.status, '200 OK')
+        self.assertIn('step 2 first', res.body)
+        self.assertEqual(self.actions_db.db_count(), 1)
+        form = res.forms['dummy']
+        form['field'] = 'value'
+        res = form.submit('submit')
+        self.assertEqual(self.actions_db.db_count(), 0)
+        self.assertEqual(res.status, '302 Found')
+        self.assertEqual(res.location, 'http://localhost/perform-action')
+
+    def test_action_prefetch(self):
+        action = deepcopy(DUMMY_ACTION)
+        action['action'] = 'dummy_prefetch'
+        self.actions_db.add_action(data=action)
+        # token verification is disabled in the setUp
+        # method of FunctionalTestCase
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        res = self.testapp.get(url)
+        res = self.testapp.get(res.location)
+        self.assertIn('first-loaded second-loaded', res.body)
+        form = res.forms['dummy']
+        res = form.submit('submit')
+        self.assertEqual(self.actions_db.db_count(), 0)
+
+    def test_current_user_loaded_once(self):
+        action = deepcopy(DUMMY_ACTION)
+        action['action'] = 'dummy_user'
+        self.actions_db.add_action(data=action)
+        amdb = self.testapp.app.registry.settings['amdb']
+        calls = []
+
+        def get_user_by_id(user_id, raise_on_missing=True):
+            calls.append(user_id)
+            return None
+
+        # token verification is disabled in the setUp
+        # method of FunctionalTestCase
+        url = ('/?userid=123467890123456789014567'
+                '&token=abc&nonce=sdf&ts=1401093117')
+        with patch.object(amdb, 'get_user_by_id', get_user_by_id):
+            res = self.testapp.get(url)
+            res = self.testapp.get(res.location)
+            self.assertEqual(len(calls), 1)
+            form = res.forms['dummy']
+            res = form.submit('submit')
+            self.assertEqual(len(calls), 3)
+        self.assertEqual(self.actions_db.db_count(), 0)
+
+
+class _SingleRequestPlugin(DummyActionPlugin2):
+
+    single_request_steps = True
+
+    @classmethod
+    def init_languages(cls, settings, locale_path, plugin_name):
+        pass
+
+
+class _EntryPoint(object):
+
+    name = 'single'
+
+    def load(self):
+        return _SingleRequestPlugin
+
+
+class PluginsRegistryTests(TestCase):
+
+    def test_single_request_steps_not_implemented(self):
+        with patch('eduid_actions.iter_entry_points',
+                   lambda name: [_EntryPoint()]):
+            with patch('eduid_actions.resource_filename',
+                       lambda package, path: path):
+                registry = PluginsRegistry('eduid_actions.action', {})
+        self.assertFalse(registry['single'].single_request_steps)
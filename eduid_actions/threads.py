@@ -0,0 +1,87 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import threading
+
+
+class ForkSafeThread(object):
+    '''
+    A daemon thread running `target`, started on demand by
+    `ensure_started` in each process that needs it.
+
+    Threads do not survive forking worker processes, so the thread is
+    started again the first time it is needed in a forked worker, after
+    calling `on_fork`, if given, to drop the state inherited from the
+    parent.
+
+    :param target: the callable run by the thread
+    :param name: the name of the thread
+    :param on_fork: called before starting the thread in a forked process
+
+    :type target: callable
+    :type name: str
+    :type on_fork: callable
+    '''
+
+    def __init__(self, target, name, on_fork=None):
+        self.target = target
+        self.name = name
+        self.on_fork = on_fork
+        self.pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        '''
+        Start the thread in this process, unless it is running.
+
+        :return: whether the thread was started for the first time
+                 in this process
+        :rtype: bool
+        '''
+        pid = os.getpid()
+        if self.pid == pid and self._thread.is_alive():
+            return False
+        with self._lock:
+            if self.pid == pid and self._thread.is_alive():
+                return False
+            new_process = self.pid != pid
+            if new_process and self.pid is not None and \
+                    self.on_fork is not None:
+                self.on_fork()
+            self.pid = pid
+            self._thread = threading.Thread(target=self.target,
+                                            name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+            return new_process
@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2018 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import copy
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+from bson import ObjectId
+
+from eduid_actions.logs import log_event
+
+import logging
+logger = logging.getLogger('eduid_actions')
+
+
+def get_current_user(request):
+    '''
+    Load from the central user db the user identified by the ``userid``
+    in the session. Set as the reified ``request.current_user``, so that
+    the user is loaded at most once per request, and shared by the core
+    and the plugins.
+
+    :param request: the request
+    :type request: pyramid.request.Request
+
+    :return: the user, or None if there is no user in the session
+             or it is not found in the db
+    :rtype: eduid_userdb.user.User
+    '''
+    userid = request.session.get('userid', None)
+    if userid is None or not ObjectId.is_valid(userid):
+        return None
+    user_oid = ObjectId(userid)
+
+    user_cache = request.registry.settings.get('user_cache')
+    if user_cache is not None:
+        user = user_cache.get(user_oid)
+    else:
+        user = request.amdb.get_user_by_id(user_oid, raise_on_missing=False)
+    if user is None:
+        log_event('user_not_found', user=userid)
+    return user
+
+
+def invalidate_current_user(request):
+    '''
+    Drop the user loaded in ``request.current_user``, so that it is
+    loaded again on next access. To be called after writing the user.
+
+    :param request: the request
+    :type request: pyramid.request.Request
+    '''
+    user = request.__dict__.pop('current_user', None)
+    user_cache = request.registry.settings.get('user_cache')
+    if user is not None and user_cache is not None:
+        user_cache.invalidate(user.user_id)
+
+
+def peek_current_user(request):
+    '''
+    Return the user in ``request.current_user`` if it has already been
+    loaded during this request, without loading it otherwise.
+
+    :param request: the request
+    :type request: pyramid.request.Request
+    :rtype: eduid_userdb.user.User or None
+    '''
+    return request.__dict__.get('current_user', None)
+
+
+class UserCache(object):
+    '''
+    Bounded cache of user documents from the central user db, shared by
+    the requests served by this process, and keyed by user_oid.
+
+    A cached document is reused for at most `ttl` seconds, and only after
+    checking, with a query that just fetches the ``modified_ts`` of the
+    user document, that it has not been modified since it was cached.
+
+    The documents are cached rather than the users, and each call to
+    `get` builds its own user from the cached document, so that the
+    changes made to it by a request are not seen by others until they
+    are saved.
+    '''
+
+    def __init__(self, amdb, max_entries=1000, ttl=30, user_class=None):
+        if user_class is None:
+            from eduid_userdb.user import User as user_class
+        self.amdb = amdb
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.user_class = user_class
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_oid):
+        '''
+        Return the user with the given id, built from the cached document
+        if it is still valid, and otherwise from a document loaded from
+        the db.
+
+        :param user_oid: the id of the user
+        :type user_oid: bson.ObjectId
+
+        :return: the user, or None if it is not found in the db
+        :rtype: eduid_userdb.user.User
+        '''
+        with self._lock:
+            entry = self._entries.get(user_oid)
+        doc = None
+        if entry is not None:
+            doc, cached_at = entry
+            if time.time() - cached_at >= self.ttl or \
+                    self._modified_ts(user_oid) != doc.get('modified_ts'):
+                self.invalidate(user_oid)
+                doc = None
+        if doc is None:
+            doc = self.amdb._coll.find_one({'_id': user_oid})
+            if doc is None:
+                return None
+            with self._lock:
+                self._entries[user_oid] = (doc, time.time())
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        # The users may change the data they are built from
+        return self.user_class(data=copy.deepcopy(doc))
+
+    def invalidate(self, user_oid):
+        with self._lock:
+            self._entries.pop(user_oid, None)
+
+    def _modified_ts(self, user_oid):
+        doc = self.amdb._coll.find_one({'_id': user_oid},
+                                       {'modified_ts': True})
+        if doc is None:
+            return None
+        return doc.get('modified_ts')
+
+
+# The caches to invalidate on update_attributes tasks, held weakly so
+# that the caches of discarded apps can be collected.
+_caches_to_invalidate = weakref.WeakSet()
+
+
+def _invalidate_on_publish(sender=None, body=None, **kwargs):
+    if sender != 'eduid_am.tasks.update_attributes':
+        return
+    if isinstance(body, dict):
+        # Celery message protocol 1
+        args = body.get('args', ())
+    else:
+        # Celery message protocol 2, (args, kwargs, embed)
+        args = body[0]
+    if len(args) > 1 and ObjectId.is_valid(str(args[1])):
+        user_oid = ObjectId(str(args[1]))
+        for user_cache in list(_caches_to_invalidate):
+            user_cache.invalidate(user_oid)
+
+
+def invalidate_on_update_attributes(user_cache):
+    '''
+    Drop users from the cache when an ``update_attributes`` task is
+    sent for them, since the attribute manager is about to write them.
+
+    :param user_cache: the user cache
+    :type user_cache: UserCache
+    '''
+    from celery.signals import before_task_publish
+
+    _caches_to_invalidate.add(user_cache)
+    # A single receiver for all the caches, connected only once
+    before_task_publish.connect(_invalidate_on_publish,
+                                dispatch_uid='eduid_actions.user_cache')
@@ -30,10 +30,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
-import os.path
+import os
+import re
+import json
+import binascii
 
 from pyramid.view import view_config
-from pyramid.response import FileResponse
+from pyramid.response import FileResponse, Response
 from pyramid.settings import asbool
 from pyramid.renderers import render_to_response
 
@@ -41,16 +44,29 @@ from pyramid.httpexceptions import HTTPFound, HTTPNotFound
 from pyramid.httpexceptions import HTTPForbidden, HTTPBadRequest
 from pyramid.httpexceptions import HTTPMethodNotAllowed
 from pyramid.httpexceptions import HTTPInternalServerError
+from pyramid.httpexceptions import HTTPException
+
+from bson import ObjectId
 
 from eduid_userdb.actions import Action
 
-from eduid_actions.auth import verify_auth_token
+from eduid_actions.action_abc import Prefetched
+from eduid_actions.audit import audit, audit_started
+from eduid_actions.audit import FINISHED, ABORTED, REMOVED
+from eduid_actions.auth import verify_auth_token, verify_internal_request
+from eduid_actions.bulk import BulkEnqueuer, parse_userids
 from eduid_actions.i18n import TranslationString as _
+from eduid_actions.logs import log_event
 
 import logging
 logger = logging.getLogger('eduid_actions')
 
 
+STEP_TOKEN_FIELD = '_step_token'
+
+_POST_FORM_RE = re.compile(r'<form\b[^>]*\bmethod=["\']?post\b[^>]*>', re.I)
+
+
 @view_config(name='favicon.ico')
 def favicon_view(context, request):
     path = os.path.dirname(__file__)
@@ -85,6 +101,23 @@ def set_language(context, request):
     return response
 
 
+def idp_url(request, idp_session):
+    '''
+    The url to send the user back to the IdP once there are
+    no pending actions left.
+    '''
+    settings = request.registry.settings
+    return '{0}?key={1}'.format(settings['idp_url'], idp_session)
+
+
+def _has_pending_actions(request, userid, idp_session):
+    index = request.registry.settings.get('pending_actions_index')
+    if index is not None and ObjectId.is_valid(userid):
+        return index.has_pending_actions(userid, idp_session)
+    action = request.actions_db.get_next_action(userid, idp_session)
+    return action is not None
+
+
 @view_config(route_name='actions',
              renderer='main.jinja2',
              request_method='GET')
@@ -101,20 +134,125 @@ def actions(request):
     shared_key = request.registry.settings.get('auth_shared_secret')
 
     if verify_auth_token(shared_key, userid, token, nonce, timestamp):
-        logger.info("Starting pre-login actions "
-                    "for userid: {0})".format(userid))
-        request.session['userid'] = userid
         idp_session = request.GET.get('session', None)
+        if not _has_pending_actions(request, userid, idp_session):
+            # Nothing to do, send the user back without creating a session
+            log_event('no_actions', user=userid)
+            return HTTPFound(location=idp_url(request, idp_session))
+        log_event('flow_start', user=userid)
+        request.session['userid'] = userid
         request.session['idp_session'] = idp_session
         return HTTPFound(location=request.route_url('perform-action'))
     else:
-        logger.info("Token authentication failed (userid: {0})".format(userid))
+        log_event('auth_failed', user=userid)
         # Show and error, the user can't be logged
         msg = _('Token authentication has failed, '
                 'you do not seem to come from a listed IdP')
         return HTTPBadRequest(msg)
 
 
+@view_config(route_name='pending-actions',
+             renderer='json',
+             request_method='GET')
+def pending_actions(request):
+    '''
+    Internal endpoint telling whether a user (optionally with a given
+    IdP session) has pending actions, answered from the in process
+    pending actions index.
+    '''
+    verify_internal_request(request)
+    index = request.registry.settings.get('pending_actions_index')
+    if index is None:
+        raise HTTPNotFound()
+    userid = request.GET.get('userid')
+    if not (userid and ObjectId.is_valid(userid)):
+        return HTTPBadRequest(_('Missing or invalid userid'))
+    idp_session = request.GET.get('session', None)
+    return {'pending': index.has_pending_actions(userid, idp_session)}
+
+
+@view_config(route_name='bulk-enqueue',
+             request_method='POST')
+def bulk_enqueue(request):
+    '''
+    Internal endpoint to enqueue an action for the users whose ids are
+    sent in the request body, as NDJSON or CSV. Progress is sent back as
+    NDJSON, one line per chunk, and logged as the chunks are written, so
+    that the last ``processed`` count can be sent back as ``skip`` to
+    resume an interrupted upload.
+    '''
+    verify_internal_request(request)
+    settings = request.registry.settings
+    action_type = request.GET.get('action')
+    fmt = request.GET.get('format', 'ndjson')
+    try:
+        preference = int(request.GET.get('preference', 100))
+        skip = int(request.GET.get('skip', 0))
+        params = json.loads(request.GET.get('params', '{}'))
+    except ValueError:
+        return HTTPBadRequest(_('Invalid bulk enqueue params'))
+    if not action_type or fmt not in ('ndjson', 'csv'):
+        return HTTPBadRequest(_('Invalid bulk enqueue params'))
+
+    enqueuer = BulkEnqueuer(
+        request.actions_db, action_type,
+        preference=preference,
+        params=params,
+        chunk_size=int(settings.get('bulk_enqueue.chunk_size', 1000)),
+        pause=float(settings.get('bulk_enqueue.pause', 0)))
+    userids = parse_userids(request.body_file, fmt)
+    logger.info('Starting bulk enqueue of action %s', action_type)
+
+    # All the writes are done here, rather than while the response is
+    # being sent, so that errors go through the exception views.
+    lines = []
+    for progress in enqueuer.enqueue(userids, skip=skip):
+        log_event('bulk_enqueue', action=action_type, **progress)
+        lines.append((json.dumps(progress) + '\n').encode('utf-8'))
+
+    return Response(body=b''.join(lines),
+                    content_type='application/x-ndjson')
+
+
+@view_config(route_name='queue-stats',
+             renderer='json',
+             request_method='GET')
+def queue_stats(request):
+    '''
+    Internal endpoint with the statistics of the pending actions,
+    cached for ``stats.cache_ttl`` seconds.
+    '''
+    verify_internal_request(request)
+    settings = request.registry.settings
+    stats = settings['queue_stats'].get()
+    pool = settings.get('redis_pool')
+    if pool is not None:
+        stats = dict(stats, redis_sentinel=pool.master.stats())
+    audit_log = settings.get('audit_log')
+    if audit_log is not None:
+        stats = dict(stats, audit=audit_log.stats())
+    return stats
+
+
+@view_config(route_name='memory-stats',
+             renderer='json',
+             request_method='GET')
+def memory_stats(request):
+    '''
+    Internal endpoint with the allocations of the sampled requests by
+    route and plugin, and the top allocation sites of the process.
+    '''
+    verify_internal_request(request)
+    stats = request.registry.settings.get('memory_stats')
+    if stats is None:
+        raise HTTPNotFound()
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        return HTTPBadRequest(_('Invalid limit'))
+    return stats.report(limit=limit)
+
+
 @view_config(route_name='perform-action')
 class PerformAction(object):
     '''
@@ -123,27 +261,37 @@ class PerformAction(object):
     def __init__(self, context, request):
         self.context = context
         self.request = request
+        settings = request.registry.settings
+        self.render_next = asbool(settings.get('render_next_action', False))
+        self.step_tokens = (self.render_next or
+                            settings.get('submit_guard') is not None)
 
     def __call__(self):
         if self.request.session.get('userid', None) is None:
             logger.info("Unidentified user")
             return HTTPForbidden()
         if self.request.method == 'GET':
-            return self.get()
+            return self._with_step_token(self.get())
         elif self.request.method == 'POST':
-            return self.post()
+            if self.render_next and not self._valid_step_token():
+                # A refreshed or resubmitted form for a step that
+                # has already been processed; show the current state.
+                log_event('stale_step',
+                          user=self.request.session['userid'])
+                url = self.request.route_url('perform-action')
+                return HTTPFound(location=url)
+            return self._guarded_post()
         return HTTPMethodNotAllowed()
 
     def get(self):
-        self.get_next_action()
+        plugin_obj, action = self.get_next_action()
         session = self.request.session
-        settings = self.request.registry.settings
-        action_type = session['current_plugin']
-        plugin_obj = settings['action_plugins'][action_type]()
-        action = Action(data=session['current_action'])
-        logger.info('Starting pre-login action {0} '
-                    'for userid {1}'.format(action.action_type,
-                                            session['userid']))
+        log_event('action_start', action=action.action_type,
+                  user=session['userid'])
+        audit_started(self.request, action)
+        if self._single_request(plugin_obj, session):
+            session['current_step'] = session['total_steps']
+            return self._render_all_steps(plugin_obj, action, session)
         try:
             template, data = plugin_obj.get_action_body_for_step(1, action, self.request)
             if template is not None:
@@ -177,26 +325,38 @@ class PerformAction(object):
 
             except plugin_obj.ValidationError as exc:
                 errors = exc.args[0]
-                logger.info('Validation error {0} '
-                            'for step {1} of action {2}'.format(
-                                str(errors),
-                                str(session['current_step']),
-                                str(action)))
+                log_event('action_step', action=action.action_type,
+                          user=session['userid'],
+                          step=session['current_step'],
+                          outcome='invalid', fields=sorted(errors))
+                # The step is rendered again
+                self._prefetch(plugin_obj, action)
+                if self._single_request(plugin_obj, session):
+                    step = getattr(exc, 'step', None) or 1
+                    return self._render_all_steps(plugin_obj, action,
+                                                  session, errors, step)
                 session['current_step'] -= 1
 
             else:
                 if updated:
-                    logger.debug('Updating action {}'.format(updated))
+                    logger.debug('Updating action %s', updated)
                     self.request.actions_db.update_action(updated)
                 else:
-                    logger.debug('Removing completed action {}'.format(action))
+                    logger.debug('Removing completed action %s', action)
                     self.request.actions_db.remove_action_by_id(action.action_id)
-                logger.info('Finished pre-login action {0} '
-                            'for userid {1}'.format(action.action_type,
-                                                    session['userid']))
+                    audit(self.request, FINISHED, action,
+                          step=session['current_step'])
+                log_event('action_step', action=action.action_type,
+                          user=session['userid'],
+                          step=session['current_step'],
+                          outcome='done')
+                if self.render_next:
+                    return self.get()
                 url = self.request.route_url('perform-action')
-                logger.debug('Redirecting user {0} to {1}'.format(session['userid'], url))
+                logger.debug('Redirecting to %s', url)
                 return HTTPFound(location=url)
+        else:
+            self._prefetch(plugin_obj, action)
 
         next_step = session['current_step'] + 1
         session['current_step'] = next_step
@@ -227,6 +387,95 @@ class PerformAction(object):
                                   {'plugin_html': html},
                                   request=self.request)
 
+    def _prefetch(self, plugin_obj, action):
+        '''
+        Start the loaders returned by the plugin's ``prefetch`` on the
+        prefetch thread pool, and hand their futures to the plugin.
+        '''
+        loaders = plugin_obj.prefetch(action, self.request)
+        if not loaders:
+            return
+        settings = self.request.registry.settings
+        executor = settings['prefetch_executor']
+        futures = dict((name, executor.submit(loader))
+                       for name, loader in loaders.items())
+        plugin_obj.prefetched = Prefetched(loaders, futures,
+                                           settings['prefetch_timeout'])
+
+    def _guarded_post(self):
+        '''
+        Process the POST, unless it duplicates one that is being or has
+        just been processed, in which case the user is sent to the
+        current state of the actions.
+        '''
+        guard = self.request.registry.settings.get('submit_guard')
+        if guard is None:
+            return self._with_step_token(self.post())
+
+        def perform():
+            try:
+                return self._with_step_token(self.post())
+            except HTTPException as exc:
+                return exc
+
+        # The form is identified by the token of the step it was rendered
+        # for, since the session may already have moved on to the next
+        # step when a duplicate arrives.
+        session = self.request.session
+        form = self.request.POST.get(STEP_TOKEN_FIELD, None)
+        if form is None:
+            form = '{0}:{1}'.format(session['current_action']['_id'],
+                                    session['current_step'])
+        key = guard.key(session['userid'], form, self.request.POST)
+        response = guard.run(key, perform)
+        if response is None:
+            url = self.request.route_url('perform-action')
+            return HTTPFound(location=url)
+        return response
+
+    def _valid_step_token(self):
+        token = self.request.POST.get(STEP_TOKEN_FIELD, None)
+        expected = self.request.session.get('step_token', None)
+        return token is not None and token == expected
+
+    def _with_step_token(self, response):
+        '''
+        When the next action is rendered directly in the POST responses,
+        or duplicate submissions are suppressed, add to the forms in the
+        response a token for the step, so that a resubmission of an old
+        form is detected.
+        '''
+        if not self.step_tokens or response.status_int != 200 or \
+                response.content_type != 'text/html':
+            return response
+        token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.request.session['step_token'] = token
+        hidden = u'<input type="hidden" name="{0}" value="{1}">'.format(
+            STEP_TOKEN_FIELD, token)
+        response.text = _POST_FORM_RE.sub(
+            lambda match: match.group(0) + hidden, response.text)
+        return response
+
+    def _single_request(self, plugin_obj, session):
+        return (getattr(plugin_obj, 'single_request_steps', False) and
+                session['total_steps'] > 1)
+
+    def _render_all_steps(self, plugin_obj, action, session,
+                          errors=None, step=1):
+        try:
+            template, data = plugin_obj.get_action_body_for_all_steps(
+                action, self.request, errors=errors, step=step)
+            if template is not None:
+                return render_to_response(template, data, request=self.request)
+            html = data
+        except plugin_obj.ActionError as exc:
+            self._aborted(action, session, exc)
+            html = u'<div class="jumbotron"><p>{0}</p></div>'
+            html = html.format(exc.args[0])
+        return render_to_response('main.jinja2',
+                                  {'plugin_html': html},
+                                  request=self.request)
+
     def get_next_action(self):
         session = self.request.session
         settings = self.request.registry.settings
@@ -234,51 +483,56 @@ class PerformAction(object):
         idp_session = session.get('idp_session', None)
         action = self.request.actions_db.get_next_action(userid, idp_session)
         if action is None:
-            logger.info("Finished pre-login actions "
-                        "for userid: {0}".format(userid))
-            idp_url = '{0}?key={1}'.format(settings['idp_url'],
-                                           self.request.session['idp_session'])
-            raise HTTPFound(location=idp_url)
+            log_event('flow_finish', user=userid)
+            raise HTTPFound(location=idp_url(self.request,
+                                             session['idp_session']))
 
         if action.action_type not in settings['action_plugins']:
-            logger.info("Missing plugin for action {0}".format(action.action_type))
+            logger.info('Missing plugin for action %s', action.action_type)
             raise HTTPInternalServerError()
 
+        # Start the prefetch first, so that it overlaps the bookkeeping
+        plugin_obj = settings['action_plugins'][action.action_type]()
+        self._prefetch(plugin_obj, action)
+
         action_dict = action.to_dict()
         action_dict['_id'] = str(action_dict['_id'])
         action_dict['user_oid'] = str(action_dict['user_oid'])
         session['current_action'] = action_dict
         session['current_step'] = 1
         session['current_plugin'] = action.action_type
-        plugin_obj = settings['action_plugins'][action.action_type]()
         session['total_steps'] = plugin_obj.get_number_of_steps()
+        return plugin_obj, action
 
     def _aborted(self, action, session, exc):
-        logger.info(u'Aborted pre-login action {0} for userid {1}, '
-                    u'reason: {2}'.format(action.action_type,
-                                          session['userid'],
-                                          exc.args[0]))
+        log_event('action_step', action=action.action_type,
+                  user=session['userid'],
+                  step=session['current_step'],
+                  outcome='aborted', reason=exc.args[0])
+        audit(self.request, ABORTED, action,
+              step=session['current_step'], reason=exc.args[0])
         if exc.remove_action:
             aid = action.action_id
-            msg = 'Removing faulty action with id '
-            logger.info(msg + str(aid))
+            logger.info('Removing faulty action with id %s', aid)
             self.request.actions_db.remove_action_by_id(aid)
+            audit(self.request, REMOVED, action,
+                  step=session['current_step'], reason=exc.args[0])
 
 
 def exception_view(context, request):
-    logger.error("The error was: %s" % context, exc_info=(context))
-    request.response.status = 500
-    return {}
+    logger.error("The error was: %s", context, exc_info=(context))
+    error_pages = request.registry.settings['error_pages']
+    return error_pages.response('error500.jinja2', 500, request)
 
 
 def not_found_view(context, request):
-    request.response.status = 404
-    return {}
+    error_pages = request.registry.settings['error_pages']
+    return error_pages.response('error404.jinja2', 404, request)
 
 
 def forbidden_view(context, request):
-    request.response.status = 403
-    return {}
+    error_pages = request.registry.settings['error_pages']
+    return error_pages.response('error403.jinja2', 403, request)
 
 
 def bad_request_view(context, request):
@@ -288,5 +542,5 @@ def bad_request_view(context, request):
 
 
 def method_not_allowed_view(context, request):
-    request.response.status = 405
-    return {}
+    error_pages = request.registry.settings['error_pages']
+    return error_pages.response('error405.jinja2', 405, request)
@@ -29,6 +29,7 @@ requires = [
     'pyramid_jinja2==2.1',
     'pyramid_beaker==0.8',
     'waitress>=0.8.9',
+    'pynacl>=1.0.1',
     'eduid_am>=0.6.1',
     'eduid_userdb>=0.0.4b3',
     'eduid_common[webapp]>=0.1.3b5',
@@ -38,6 +39,7 @@ if sys.version_info[0] < 3:
     # Babel does not work with Python 3
     requires.append('Babel==1.3')
     requires.append('lingua==1.5')
+    requires.append('futures>=3.0.5')
 
 
 test_requires = [
@@ -77,10 +79,16 @@ setup(name='eduid_actions',
       extras_require={
           'docs': docs_extras,
           'testing': testing_extras,
+          'brotli': ['brotlipy>=0.7.0'],
       },
       test_suite="eduid_actions",
       entry_points="""\
       [paste.app_factory]
       main = eduid_actions:main
+      [console_scripts]
+      eduid-actions-enqueue = eduid_actions.bulk:main
+      eduid-actions-purge = eduid_actions.purge:main
+      eduid-actions-stats = eduid_actions.stats:main
+      eduid-actions-bench = eduid_actions.benchmarks:main
       """,
       )